@@ -2,15 +2,37 @@
 
 import os
 import sys
+import time
+import glob
 import shutil
 
+import re
 import json
+import pipes
+import zlib
+import fcntl
+import errno
+import ctypes
+import select
+import struct
+import base64
+import socket
 import urllib
+import sqlite3
+import httplib
+import hashlib
+import tempfile
 import zipfile
+import urlparse
 import argparse
+import threading
 import subprocess
+import StringIO
 import HTMLParser
+import collections
 import multiprocessing
+import multiprocessing.pool
+import ctypes.util
 import xml.etree.ElementTree
 
 
@@ -22,9 +44,32 @@ USER_HOME = os.path.expanduser("~")
 TOOL_DIR = USER_HOME + "/.stm32tool"
 
 TEMPLATES_DIR = TOOL_DIR + "/templates"
+TEMPLATES_INDEX_FILE = TEMPLATES_DIR + "/index.json"
+TEMPLATES_MANIFESTS_DIR = TEMPLATES_DIR + "/manifests"
+TEMPLATES_BLOBS_DIR = TEMPLATES_DIR + "/blobs"
+TEMPLATES_LIBS_DIR = TEMPLATES_DIR + "/libs"
 TEMP_DIR = TOOL_DIR + "/temp"
 
-MCU_DB_FILE = TOOL_DIR + "/mcu_db.json"
+MCU_DB_FILE = TOOL_DIR + "/mcu_db.sqlite"
+MCU_DB_LEGACY_FILE = TOOL_DIR + "/mcu_db.json"
+MCU_DB_HTTP_FILE = TOOL_DIR + "/mcu_db.http.json"
+MCU_DB_LOCK_FILE = TOOL_DIR + "/mcu_db.lock"
+MCU_DB_LOG_FILE = TOOL_DIR + "/mcu_db.log"
+
+CONFIG_FILE = TOOL_DIR + "/config.json"
+PROJECTS_REGISTRY_FILE = TOOL_DIR + "/projects.json"
+VERIFIED_BUILDS_FILE = TOOL_DIR + "/verified.json"
+COMPILERS_FILE = TOOL_DIR + "/compilers.json"
+
+OBJCACHE_DIR = TOOL_DIR + "/objcache"
+OBJCACHE_HITS_FILE = OBJCACHE_DIR + "/hits" # One byte for each hit
+OBJCACHE_MISSES_FILE = OBJCACHE_DIR + "/misses" # The size of each object added
+OBJCACHE_SIZE_FILE = OBJCACHE_DIR + "/size.json" # Size at the last check
+
+CACHE_DIR = TOOL_DIR + "/cache"
+CACHE_INDEX_FILE = CACHE_DIR + "/index.json"
+CACHE_BLOBS_DIR = CACHE_DIR + "/blobs"
+CACHE_DOWNLOADS_DIR = CACHE_DIR + "/downloads"
 
 
 '''
@@ -57,10 +102,83 @@ HAL_PACKAGE_PAGE_URL = (WEBSITE_BASE_URL +
                         "/stm32-embedded-software/stm32cube-embedded-software"
                         "/stm32cube{}{}.html")
 
+# Columns of the product grid saved in the local MCU database, as
+# (field, text to search in the column name, required) tuples
+MCU_DB_COLUMNS = [
+    ('flash', 'FLASH', True),
+    ('ram', 'RAM', True),
+    ('core', 'Core', False),
+    ('frequency', 'Frequency', False),
+    ('package', 'Package', False)
+]
+MCU_DB_INTEGER_COLUMNS = ('flash', 'ram', 'frequency')
+
 HAL_PACKAGE_PAGE_LINK_SEARCH_TAG = 'div' # Search for this kind of HTML tag
 HAL_PACKAGE_PAGE_LINK_SEARCH_ATTRS = {'id': 'dlLink'} # With these attributes
 HAL_PACKAGE_PAGE_LINK_ATTR = 'data-download-path' # Get link from attribute
 
+DOWNLOAD_CHUNK_COUNT = 4 # Number of ranges fetched at the same time
+DOWNLOAD_MIN_CHUNK_SIZE = 1024 * 1024 # Don't split files smaller than this
+DOWNLOAD_BLOCK_SIZE = 64 * 1024 # Size of each network read
+DOWNLOAD_RETRIES = 3 # Attempts for each range before giving up
+DOWNLOAD_STATE_SAVE_INTERVAL = 1.0 # Seconds between '.part' state saves
+
+HTTP_USER_AGENT = 'stm32tool'
+HTTP_TIMEOUT = 60 # Seconds before a stalled connection is dropped
+HTTP_MAX_REDIRECTS = 5
+
+MAX_PARALLEL_DOWNLOADS = 4 # Packages downloaded at the same time in batch mode
+
+MAKE_OUTPUT_TAIL_LINES = 50 # Lines of the build output kept for error reports
+
+PROJECT_TOOL_DIR = ".stm32tool" # Files of the tool inside each project
+HAL_SOURCES_MK = "build/hal_sources.mk" # HAL sources used by a project
+HAL_UNITY_DIR = "build/unity" # Translation units of a unity build of the HAL
+PROFILE_LOG_FILE = "build/profile.log" # Timings recorded while profiling a build
+PROFILE_FILE = "build/profile.json" # Report of a profiled build
+PROFILE_TRACE_FILE = "build/profile_trace.json" # Same, as a Chrome trace
+PROFILE_REPORT_ENTRIES = 10 # Slowest steps and most included headers printed
+SIZE_HISTORY_FILE = PROJECT_TOOL_DIR + "/size_history.json" # Footprint of the last builds
+SYSTEM_HASHES_FILE = PROJECT_TOOL_DIR + "/system_hashes.json" # Content hash of the system files
+SIZE_HISTORY_ENTRIES = 20 # Builds kept in the size history of a project
+SIZE_REPORT_ENTRIES = 15 # Objects, symbols and differences printed by 'size'
+SIZE_LTO_OBJECTS = "(LTO partitions)" # All the objects created by the link time optimization
+SWEEP_DIR = "build/sweep" # Build directories of the 'sweep' configurations
+SCAN_CACHE_FILE = PROJECT_TOOL_DIR + "/scan_cache.json" # Line counts of the project files, for 'info'
+SCAN_READ_SIZE = 1024 * 1024 # Bytes read at once when counting lines
+SCAN_PARALLEL_SIZE = 16 * 1024 * 1024 # Bytes to count from which a pool of processes is used
+SWEEP_OPTIMIZATIONS = ('-Os', '-O1', '-O2', '-O3') # Levels built by 'sweep'
+
+# Function name prefixes of the HAL modules with a different name
+HAL_MODULE_ALIASES = { 'nvic': 'cortex', 'systick': 'cortex', 'mpu': 'cortex' }
+
+TEMPLATES_GC_GRACE_PERIOD = 3600 # Seconds a new template blob is kept unreferenced
+
+FICLONE = 0x40049409 # Linux ioctl() request to clone a file with a reflink
+
+WATCH_DEBOUNCE = 0.1 # Seconds without changes before 'watch' starts a build
+WATCH_POLL_INTERVAL = 0.5 # Seconds between two scans when inotify isn't available
+WATCH_EXTENSIONS = ('.c', '.h', '.s', '.S', '.ld', '.mk') # Files 'watch' reacts to
+
+# Linux inotify constants
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+
+# Default values for the options that can be overridden in CONFIG_FILE
+DEFAULT_CONFIG = {
+    'cacheSizeLimitMB': 2048, # Max size of the download cache, LRU evicted
+    'cachePageTTL': 7 * 24 * 3600, # Seconds a scraped page result stays valid
+    'mcuDBTTL': 30 * 24 * 3600, # Seconds before the MCU database is refreshed
+    'linkTemplates': False, # Hardlink the system files of new projects
+    'objcache': False, # Share the compiled objects between the projects
+    'objcacheSizeLimitMB': 1024 # Max size of the object cache, LRU evicted
+}
+
 class CLIFormat:
     INFO = '\033[34m'
     WARNING = '\033[33m'
@@ -111,51 +229,168 @@ def copyDirContent(srcDir, dstDir):
         else:
             shutil.copyfile(srcDir + "/" + f, dstDir + "/" + f)
 
-# ZIPs the entire content of a directory in a new ZIP file
-# NOTE: the ZIP file will have the directory content at its root, it will not
-#       contain the specified directory itself
-def zipDirContent(path, zipFilename):
-    zipHandle = zipfile.ZipFile(zipFilename, 'w', zipfile.ZIP_DEFLATED)
-    for root, dirs, files in os.walk(path):
-        for file in dirs + files:
-            srcFilename = os.path.join(root, file)
-            arcFilename = os.path.relpath(os.path.join(root, file),
-                                          os.path.join(path, '.'))
-            zipHandle.write(srcFilename, arcFilename)
-    zipHandle.close()
+# Make 'dst' a hardlink to 'src'. If that's not possible (like on another
+# filesystem) try to clone it with a reflink, and finally copy it
+def linkFile(src, dst):
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        if not e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    with open(src, 'rb') as srcFile, open(dst, 'wb') as dstFile:
+        try:
+            fcntl.ioctl(dstFile.fileno(), FICLONE, srcFile.fileno())
+            return
+        except IOError:
+            shutil.copyfileobj(srcFile, dstFile)
+    shutil.copymode(src, dst)
 
-# Count number of files with specified extensions in 'path', without searching
-# in directories listed in 'noDirs'
-# Returns a dictionary with the number of files for each extension, and also
-# the number of files that do not belong to any of the extensions given. The
-# dictionary also contains the total number of files
-def countFiles(path, extensions, noDirs=()):
-    output = { 'other': 0, 'total': 0 }
-    for e in extensions:
-        output[e] = 0
-    for root, dirs, files in os.walk(path, topdown=True):
-        dirs[:] = [d for d in dirs if d not in noDirs]
-        if root in noDirs:
-            continue
-        for f in files:
-            extension = f.split('.')[-1]
-            if extension in output:
-                output[extension] += 1
-            else:
-                output['other'] += 1
-        output['total'] += len(files)
-    return output
+# List the files of a ZIP archive under the 'prefix' directory, reading just
+# the central directory. Returns (member name, path relative to prefix) tuples
+def listZipDir(zf, prefix, recursive=True):
+    result = []
+    for name in zf.namelist():
+        if not name.startswith(prefix) or name.endswith('/'): continue
+        path = name[len(prefix):]
+        if recursive or not '/' in path:
+            result.append((name, path))
+    return result
 
-# Counts the number of code lines in path (searching all subdirectories)
-# Considers only files with the given extensions
-def countCodeLines(path, extensions):
+# List the names of the directories directly under 'prefix' in a ZIP archive
+def listZipSubdirs(zf, prefix):
+    subdirs = set()
+    for name in zf.namelist():
+        if name.startswith(prefix) and '/' in name[len(prefix):]:
+            subdirs.add(name[len(prefix):].split('/')[0])
+    return sorted(subdirs)
+
+# Count the lines of a file the same way iterating over it would (a last line
+# without newline also counts), reading it in big blocks
+def countFileLines(filename):
     count = 0
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            if f.split('.')[-1] in extensions:
-                with open(os.path.join(root, f), 'r') as fh:
-                    count += sum(1 for line in fh)
-    return count
+    last = '\n'
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(SCAN_READ_SIZE)
+            if not block:
+                break
+            count += block.count('\n')
+            last = block[-1]
+    return count if last == '\n' else count + 1
+
+# countFileLines() for a pool of workers, which returns the file with its count
+def countFileLinesWorker(filename):
+    try:
+        return (filename, countFileLines(filename))
+    except (IOError, OSError):
+        return (filename, 0)
+
+# Scan all the files of a project in one pass, without entering its build and
+# PROJECT_TOOL_DIR directories. The lines of the files with the given
+# extensions are counted, reusing the counts in SCAN_CACHE_FILE of the files
+# whose modification time and size did not change; when there is a lot to
+# read, the files are counted in a pool of processes.
+# Returns an ordered dictionary with the counts of each top level directory
+# ('.' for the files in the project root) and the 'total' counts. Each entry
+# has the number of files for each extension, 'other', 'total' and 'lines'
+def scanProject(projectDir, extensions=('c', 'h')):
+    cacheFilename = projectDir + "/" + SCAN_CACHE_FILE
+    try:
+        with open(cacheFilename) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = { }
+
+    def newCounts():
+        counts = { 'other': 0, 'total': 0, 'lines': 0 }
+        for e in extensions:
+            counts[e] = 0
+        return counts
+
+    counts = collections.OrderedDict()
+    files = { }
+    for root, dirs, names in os.walk(projectDir, topdown=True):
+        if root == projectDir:
+            dirs[:] = [d for d in dirs if d not in ('build', PROJECT_TOOL_DIR)]
+        dirs.sort()
+        relativeRoot = os.path.relpath(root, projectDir)
+        topDir = relativeRoot.split(os.sep)[0]
+        if topDir not in counts:
+            counts[topDir] = newCounts()
+        for name in names:
+            extension = name.split('.')[-1]
+            if extension in extensions:
+                counts[topDir][extension] += 1
+                filename = os.path.normpath(os.path.join(relativeRoot, name))
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                files[filename] = (topDir, [stat.st_mtime, stat.st_size])
+            else:
+                counts[topDir]['other'] += 1
+            counts[topDir]['total'] += 1
+
+    newCache = { }
+    pending = [ ]
+    for filename, (topDir, key) in files.items():
+        cached = cache.get(filename)
+        if cached is not None and cached[:2] == key:
+            newCache[filename] = cached
+        else:
+            pending.append(filename)
+
+    if len(pending) > 0:
+        paths = [os.path.join(projectDir, filename) for filename in pending]
+        if sum(files[filename][1][1] for filename in pending) >= SCAN_PARALLEL_SIZE and getCPUcount() > 1:
+            countPool = multiprocessing.Pool(getCPUcount())
+            lines = dict(countPool.imap_unordered(countFileLinesWorker, paths, 16))
+            countPool.close()
+            countPool.join()
+        else:
+            lines = dict(map(countFileLinesWorker, paths))
+        for filename, path in zip(pending, paths):
+            newCache[filename] = files[filename][1] + [lines[path]]
+
+    for filename, (topDir, key) in files.items():
+        counts[topDir]['lines'] += newCache[filename][2]
+
+    if newCache != cache:
+        try:
+            if not os.path.isdir(projectDir + "/" + PROJECT_TOOL_DIR):
+                os.makedirs(projectDir + "/" + PROJECT_TOOL_DIR)
+            writeJSONAtomic(cacheFilename, newCache)
+        except (IOError, OSError):
+            pass
+
+    total = newCounts()
+    for topDir in counts:
+        for k in total:
+            total[k] += counts[topDir][k]
+    counts['total'] = total
+    return counts
+
+# Read the variables assigned in a Makefile fragment (like config.mk or
+# dirs.mk), handling the '=', ':=', '?=' and '+=' assignments, comments, line
+# continuations and references to the variables already read. Returns a
+# dictionary with the value of each variable
+def loadMakeVariables(filename, variables=None):
+    variables = dict(variables) if variables is not None else { }
+    with open(filename) as f:
+        content = f.read().replace('\\\n', ' ')
+    for line in content.splitlines():
+        line = line.split('#')[0].strip()
+        match = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)\s*(\+=|:=|\?=|=)\s*(.*)$', line)
+        if match is None:
+            continue
+        name, operator, value = match.groups()
+        value = re.sub(r'\$[({]([A-Za-z0-9_]+)[)}]', lambda m: variables.get(m.group(1), ''), value.strip())
+        if operator == '+=' and name in variables:
+            variables[name] = (variables[name] + ' ' + value).strip()
+        elif operator != '?=' or not name in variables:
+            variables[name] = value
+    return variables
 
 # Return the number of CPU cores of the machine, used to run 'make' on
 # multiple cores to improve compiling speed
@@ -171,90 +406,1132 @@ def replaceInFile(filename, search, replace):
     with open(filename, 'w') as f:
         f.write(content)
 
-# Downloads a file and shows a text-based progress bar.
-# If 'saveToDisk' is True, the file is saved to 'location' and the complete
-# filename is returned, otherwise the file content is returned as a string
-def downloadFile(url, saveToDisk=True, location='.'):
-    filename = url.split('/')[-1]
+# Write a JSON object to a file atomically (through a temporary file and a
+# rename), so that a concurrent reader never sees a partially written file
+def writeJSONAtomic(filename, obj):
+    tempFilename = filename + ".tmp" + str(os.getpid()) + "." + str(threading.current_thread().ident)
+    with open(tempFilename, 'w') as f:
+        json.dump(obj, f)
+    os.rename(tempFilename, filename)
 
-    def computeBestSizeUnit(size):
-        unit = 'bytes'
-        div = 1
-        if size >= (1024 / 2):
-            unit = 'kB'
-            div = 1024
-        if size >= (1024 * 1024 / 2):
-            unit = 'MB'
-            div = 1024 * 1024
-        return (unit, div)
-
-    def printProgress(count, blockSize, totalSize):
-        if totalSize == -1:
-            bytesSoFar = count * blockSize
-            sizeUnit = computeBestSizeUnit(bytesSoFar)
-            sys.stdout.write("\x1b[2K\rDownloading %s [%.1f %s]" % (filename, float(bytesSoFar) / float(sizeUnit[1]), sizeUnit[0]))
-            sys.stdout.flush()
+# Return the value of a tool option, from CONFIG_FILE if the user set it
+# there, otherwise from DEFAULT_CONFIG
+def getConfig(key):
+    if not hasattr(getConfig, 'userConfig'):
+        try:
+            with open(CONFIG_FILE) as f:
+                getConfig.userConfig = json.load(f)
+        except:
+            getConfig.userConfig = { }
+    return getConfig.userConfig.get(key, DEFAULT_CONFIG.get(key))
+
+# Format a size in bytes with the most readable unit
+def formatSize(size):
+    for unit in ('bytes', 'kB', 'MB'):
+        if abs(size) < 1024 / 2:
+            return "{:.1f} {}".format(size, unit) if unit != 'bytes' else "{} {}".format(size, unit)
+        size = float(size) / 1024
+    return "{:.1f} GB".format(size)
+
+# Exclusive lock on a file, used as a context manager to serialize the
+# processes that update the same files in TOOL_DIR. A non blocking lock
+# doesn't wait for other processes: check 'acquired' to know if it was taken
+class FileLock:
+
+    def __init__(self, filename, blocking=True):
+        self.filename = filename
+        self.blocking = blocking
+        self.handle = None
+        self.acquired = False
+
+    def __enter__(self):
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        self.handle = open(self.filename, 'a')
+        try:
+            fcntl.flock(self.handle, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.acquired = True
+        except IOError:
+            if self.blocking:
+                raise
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.acquired:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+            self.acquired = False
+        self.handle.close()
+        return False
+
+
+'''
+    HTTP functions
+'''
+# Response returned by HTTPConnectionPool.request(). The body is transparently
+# decompressed when the server sent it gzip encoded, and the connection goes
+# back to the pool when the response is closed after being read completely
+class HTTPResponse:
+
+    def __init__(self, pool, key, connection, response, url):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.buffer = b''
+        self.decoder = None
+        if (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def getcode(self):
+        return self.response.status
+
+    def getheader(self, name):
+        return self.response.getheader(name)
+
+    def read(self, size=-1):
+        if self.decoder is None:
+            return self.response.read() if size < 0 else self.response.read(size)
+        while size < 0 or len(self.buffer) < size:
+            raw = self.response.read(DOWNLOAD_BLOCK_SIZE)
+            if not raw:
+                self.buffer += self.decoder.flush()
+                break
+            self.buffer += self.decoder.decompress(raw)
+        if size < 0:
+            data, self.buffer = self.buffer, b''
         else:
-            bytesSoFar = count * blockSize
-            if bytesSoFar > totalSize: totalSize = bytesSoFar
-            sizeUnit = computeBestSizeUnit(totalSize)
-            percent = int(float(count * blockSize) / float(totalSize) * 100.0)
-            sys.stdout.write("\x1b[2K\rDownloading %s [%d%% of %.1f %s]" % (filename, percent, float(totalSize) / float(sizeUnit[1]), sizeUnit[0]))
-            sys.stdout.flush()
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        if self.connection is None: return
+        if not self.response.isclosed() and self.response.length == 0:
+            self.response.read()
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.pool.release(self.key, self.connection, reusable)
+        self.connection = None
+
+# Keeps the HTTP(S) connections alive between requests to the same host, so
+# that the ST pages, the MCU database and the download ranges don't pay a new
+# TCP (and TLS) handshake for every request. Safe to use from many threads:
+# each request takes a connection for itself until the response is closed
+class HTTPConnectionPool:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = { }
+
+    def acquire(self, key):
+        with self.lock:
+            if len(self.idle.get(key, [])) > 0:
+                return (self.idle[key].pop(), True)
+        scheme, host, port = key
+        proxy = urllib.getproxies().get(scheme)
+        if proxy is not None and not urllib.proxy_bypass(host):
+            proxyURL = urlparse.urlsplit(proxy)
+            if scheme == 'https':
+                connection = httplib.HTTPSConnection(proxyURL.hostname, proxyURL.port or 443, timeout=HTTP_TIMEOUT)
+                connection.set_tunnel(host, port)
+            else:
+                connection = httplib.HTTPConnection(proxyURL.hostname, proxyURL.port or 80, timeout=HTTP_TIMEOUT)
+                connection.viaProxy = True
+        elif scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=HTTP_TIMEOUT)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=HTTP_TIMEOUT)
+        return (connection, False)
+
+    def release(self, key, connection, reusable):
+        if not reusable:
+            connection.close()
+            return
+        with self.lock:
+            self.idle.setdefault(key, []).append(connection)
+
+    # Send a GET request, following redirects. Raises IOError for error
+    # responses, and returns an HTTPResponse otherwise (304 included)
+    def request(self, url, headers=None, gzip=False):
+        for redirect in range(HTTP_MAX_REDIRECTS + 1):
+            parsedURL = urlparse.urlsplit(url)
+            scheme = parsedURL.scheme.lower()
+            port = parsedURL.port or (443 if scheme == 'https' else 80)
+            key = (scheme, parsedURL.hostname, port)
+            requestHeaders = {'User-Agent': HTTP_USER_AGENT,
+                              'Accept-Encoding': 'gzip' if gzip else 'identity'}
+            requestHeaders.update(headers or {})
+            for attempt in range(2):
+                connection, reused = self.acquire(key)
+                path = parsedURL.path or '/'
+                if parsedURL.query: path += '?' + parsedURL.query
+                if getattr(connection, 'viaProxy', False): path = url
+                try:
+                    connection.request('GET', path, headers=requestHeaders)
+                    response = connection.getresponse()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    connection.close()
+                    # A kept alive connection may have been closed by the
+                    # server in the meantime, retry once on a new one
+                    if not reused or attempt == 1:
+                        raise
+            wrapped = HTTPResponse(self, key, connection, response, url)
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                wrapped.read()
+                wrapped.close()
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status >= 400:
+                wrapped.read()
+                wrapped.close()
+                raise IOError("HTTP Error {}: {}".format(response.status, response.reason))
+            return wrapped
+        raise IOError("Too many HTTP redirects")
+
+HTTP_POOL = HTTPConnectionPool()
+
+# Send an HTTP GET request through the shared connection pool and return the
+# response object. Additional headers (for example 'Range') can be specified
+# with the 'headers' dictionary, 'gzip' allows a compressed transfer
+def httpRequest(url, headers=None, gzip=False):
+    return HTTP_POOL.request(url, headers, gzip)
+
+# Return the headers for a conditional request from the 'etag' and
+# 'lastModified' validators of a previous response
+def getConditionalHeaders(validators):
+    headers = { }
+    if validators is not None:
+        if validators.get('etag') is not None:
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('lastModified') is not None:
+            headers['If-Modified-Since'] = validators['lastModified']
+    return headers
+
+# Return the validators of a response, to be used for the next request
+def getResponseValidators(response):
+    return {'etag': response.getheader('ETag'),
+            'lastModified': response.getheader('Last-Modified')}
+
+# Print a text-based progress bar for a download. The progress bar is disabled
+# when many downloads run at the same time
+SHOW_DOWNLOAD_PROGRESS = True
+
+def printDownloadProgress(filename, bytesSoFar, totalSize):
+    if not SHOW_DOWNLOAD_PROGRESS:
+        return
+    if totalSize is None:
+        sys.stdout.write("\x1b[2K\rDownloading %s [%s]" % (filename, formatSize(bytesSoFar)))
+        sys.stdout.flush()
+    else:
+        if bytesSoFar > totalSize: totalSize = bytesSoFar
+        percent = int(float(bytesSoFar) / float(max(totalSize, 1)) * 100.0)
+        sys.stdout.write("\x1b[2K\rDownloading %s [%d%% of %s]" % (filename, percent, formatSize(totalSize)))
+        sys.stdout.flush()
+
+def finishDownloadProgress():
+    if SHOW_DOWNLOAD_PROGRESS:
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+
+
+# Ask the server for the size of the resource at 'url' and whether it supports
+# HTTP Range requests, by requesting just the first byte of it.
+# Returns a dictionary with 'size' (None if unknown), 'ranges', 'etag',
+# 'lastModified' and 'md5' (the Content-MD5 header of a whole-file response, if any)
+def probeDownload(url):
+    response = httpRequest(url, {'Range': 'bytes=0-0'})
+    info = {'size': None,
+            'ranges': False,
+            'etag': response.getheader('ETag'),
+            'lastModified': response.getheader('Last-Modified'),
+            'md5': None}
+    contentRange = response.getheader('Content-Range')
+    # The Content-MD5 of a partial response digests only the range sent, so
+    # it's trusted only when the server answered with the whole file
+    if response.getcode() == 200:
+        info['md5'] = response.getheader('Content-MD5')
+    if response.getcode() == 206 and contentRange is not None:
+        total = contentRange.split('/')[-1].strip()
+        if total.isdigit():
+            info['size'] = int(total)
+            info['ranges'] = True
+        response.read()
+    elif response.getheader('Content-Length') is not None:
+        info['size'] = int(response.getheader('Content-Length'))
+    response.close()
+    return info
+
+# Compute the hex digest of a file with the given hashlib algorithm
+def computeFileHash(filename, algorithm='sha256'):
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Split 'size' bytes into at most 'count' [start, end, done] ranges
+def splitDownloadRanges(size, count):
+    count = max(1, min(count, size // DOWNLOAD_MIN_CHUNK_SIZE))
+    chunkSize = size // count
+    ranges = []
+    for i in range(count):
+        start = i * chunkSize
+        end = size - 1 if i == count - 1 else start + chunkSize - 1
+        ranges.append([start, end, 0])
+    return ranges
+
+# Fetch the ranges listed in 'state' with concurrent HTTP Range requests,
+# writing each of them at its offset inside 'partFilename'. The progress of
+# every range is periodically saved to 'stateFilename', so that an interrupted
+# download can be resumed by the next run. 'reportProgress' is called with the
+# number of bytes downloaded so far.
+# Returns True when all the ranges have been fetched, False otherwise
+def downloadRanges(url, partFilename, stateFilename, state, reportProgress):
+    lock = threading.Lock()
+    stop = threading.Event()
+    failures = []
+
+    def saveState():
+        with lock:
+            with open(stateFilename, 'w') as f:
+                json.dump(state, f)
+
+    def fetchRange(chunk):
+        attempts = 0
+        while chunk[0] + chunk[2] <= chunk[1] and not stop.is_set():
+            try:
+                rangeHeader = 'bytes={}-{}'.format(chunk[0] + chunk[2], chunk[1])
+                response = httpRequest(url, {'Range': rangeHeader})
+                if response.getcode() != 206:
+                    raise IOError("the server ignored the Range request")
+                received = chunk[2]
+                with open(partFilename, 'r+b') as f:
+                    f.seek(chunk[0] + chunk[2])
+                    while not stop.is_set():
+                        toRead = min(DOWNLOAD_BLOCK_SIZE, chunk[1] - chunk[0] - chunk[2] + 1)
+                        if toRead <= 0: break
+                        block = response.read(toRead)
+                        if not block: break
+                        f.write(block)
+                        with lock:
+                            chunk[2] += len(block)
+                response.close()
+                if chunk[2] == received and not stop.is_set():
+                    raise IOError("the server sent no data for the range")
+            except Exception as e:
+                attempts += 1
+                if attempts >= DOWNLOAD_RETRIES:
+                    failures.append(e)
+                    stop.set()
+                    return
+                time.sleep(attempts)
+
+    if not os.path.isfile(partFilename):
+        with open(partFilename, 'wb') as f:
+            f.truncate(state['size'])
+    saveState()
+
+    threads = [threading.Thread(target=fetchRange, args=(chunk,)) for chunk in state['chunks']]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    lastSave = time.time()
+    try:
+        while any(t.is_alive() for t in threads):
+            time.sleep(0.1)
+            reportProgress(sum(chunk[2] for chunk in state['chunks']))
+            if time.time() - lastSave >= DOWNLOAD_STATE_SAVE_INTERVAL:
+                saveState()
+                lastSave = time.time()
+    except KeyboardInterrupt:
+        stop.set()
+        for t in threads:
+            t.join()
+        saveState()
+        raise
+    saveState()
+
+    if len(failures) > 0:
+        finishDownloadProgress()
+        WARNING("Download failed: " + str(failures[0]))
+        return False
+    return True
+
+# Fetch a file with a single HTTP stream. If 'output' is None the content is
+# returned as a string, otherwise it's written to the 'output' file object
+def downloadStream(url, output, reportProgress):
+    response = httpRequest(url)
+    blocks = []
+    bytesSoFar = 0
+    while True:
+        block = response.read(DOWNLOAD_BLOCK_SIZE)
+        if not block: break
+        bytesSoFar += len(block)
+        if output is None:
+            blocks.append(block)
+        else:
+            output.write(block)
+        reportProgress(bytesSoFar)
+    response.close()
+    return b''.join(blocks) if output is None else None
+
+# File-like wrapper of a page download response that shows a text-based
+# progress bar while the content is read
+class DownloadProgressReader:
+
+    def __init__(self, response, filename):
+        self.response = response
+        self.filename = filename
+        self.bytesSoFar = 0
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        if data:
+            self.bytesSoFar += len(data)
+            printDownloadProgress(self.filename, self.bytesSoFar, None)
+        return data
+
+    def close(self):
+        self.response.close()
+        finishDownloadProgress()
+
+# Open a page (like the MCU database or a HAL package page) for reading,
+# allowing a compressed transfer. If the 'validators' of a previous download
+# are given the request is conditional.
+# Returns a (status, stream, validators) tuple, where stream is None if the
+# status is 304 (the previous copy is still valid). The stream shows a
+# progress bar while it's read and must be closed by the caller
+def openPage(url, validators=None):
+    response = httpRequest(url, getConditionalHeaders(validators), gzip=True)
+    if response.getcode() == 304:
+        response.close()
+        return (304, None, validators)
+    stream = DownloadProgressReader(response, url.split('/')[-1])
+    return (response.getcode(), stream, getResponseValidators(response))
+
+# Download a page with openPage() and return a (status, content, validators)
+# tuple: status is 304 (and content None) if the previous copy is still valid,
+# and None if the download failed
+def downloadPage(url, validators=None):
+    try:
+        status, stream, validators = openPage(url, validators)
+        if stream is None:
+            return (status, None, validators)
+        blocks = []
+        while True:
+            block = stream.read(DOWNLOAD_BLOCK_SIZE)
+            if not block: break
+            blocks.append(block)
+        stream.close()
+    except KeyboardInterrupt:
+        print "\b\b [INTERRUPTED]"
+        return (None, None, None)
+    except Exception as e:
+        finishDownloadProgress()
+        WARNING("Download failed: " + str(e))
+        return (None, None, None)
+    return (status, b''.join(blocks), validators)
+
+# Parse a JSON object incrementally from a file-like 'stream', yielding a
+# (key, value) tuple for each of its members. The arrays of the members listed
+# in 'streamedKeys' are not loaded at once: a (key, element) tuple is yielded
+# for each of their elements instead, so that the memory used doesn't depend
+# on the array length
+def iterJSONObjectMembers(stream, streamedKeys=()):
+    decoder = json.JSONDecoder()
+    state = { 'buffer': '', 'pos': 0, 'eof': False }
+
+    def readMore():
+        if state['pos'] > DOWNLOAD_BLOCK_SIZE:
+            state['buffer'] = state['buffer'][state['pos']:]
+            state['pos'] = 0
+        block = stream.read(DOWNLOAD_BLOCK_SIZE)
+        if not block:
+            state['eof'] = True
+        state['buffer'] += block
+        return bool(block)
+
+    def peek():
+        while True:
+            buf = state['buffer']
+            while state['pos'] < len(buf) and buf[state['pos']] in ' \t\r\n':
+                state['pos'] += 1
+            if state['pos'] < len(buf):
+                return buf[state['pos']]
+            if not readMore():
+                raise ValueError("Unexpected end of JSON data")
+
+    def expect(chars):
+        c = peek()
+        if not c in chars:
+            raise ValueError("Unexpected '{}' in JSON data".format(c))
+        state['pos'] += 1
+        return c
 
+    def decodeValue():
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(state['buffer'], state['pos'])
+                # A value ending exactly at the end of the buffer (like a
+                # number) may continue in the next block
+                if end < len(state['buffer']) or state['eof']:
+                    state['pos'] = end
+                    return value
+            except ValueError:
+                if state['eof']:
+                    raise
+            readMore()
+
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        key = decodeValue()
+        expect(':')
+        if key in streamedKeys and peek() == '[':
+            expect('[')
+            if peek() == ']':
+                expect(']')
+            else:
+                while True:
+                    yield (key, decodeValue())
+                    if expect(',]') == ']': break
+        else:
+            yield (key, decodeValue())
+        if expect(',}') == '}': break
+
+# Downloads a file and shows a text-based progress bar.
+# If 'saveToDisk' is True, the file is saved to 'location' and the complete
+# filename is returned, otherwise the file content is returned as a string.
+# Files saved to disk are fetched in parallel ranges when the server supports
+# it, and an interrupted download leaves a '.part' file behind that the next
+# run resumes. The assembled file is checked against the expected size and
+# against the 'sha256' checksum (if given), the server Content-MD5 (if sent)
+# or the CRC of the members of a zip file; a corrupted file is discarded and
+# downloaded again, up to DOWNLOAD_RETRIES times
+def downloadFile(url, saveToDisk=True, location='.', sha256=None):
     if saveToDisk == False:
-        if not os.path.isdir(TEMP_DIR):
-            os.makedirs(TEMP_DIR)
-        location = TEMP_DIR
+        return downloadPage(url)[1]
+    for attempt in range(DOWNLOAD_RETRIES):
+        result = downloadFileAttempt(url, location, sha256)
+        if result is not False:
+            return result
+    WARNING("Giving up the download of " + url)
+    return None
+
+# Tell if a zip file can be read and all its members match their CRC
+def isValidZipFile(filename):
+    try:
+        with zipfile.ZipFile(filename) as z:
+            return z.testzip() is None
+    except (zipfile.BadZipfile, IOError, zlib.error):
+        return False
+
+# Download a file to 'location' once (see downloadFile()). Returns the complete
+# filename, None if the download failed, or False if the file was incomplete
+# or corrupted and it's worth another attempt
+def downloadFileAttempt(url, location, sha256):
+    filename = url.split('/')[-1]
+
+    def printProgress(bytesSoFar, totalSize):
+        printDownloadProgress(filename, bytesSoFar, totalSize)
 
     completeFilename = location + "/" + filename
+    partFilename = completeFilename + ".part"
+    stateFilename = partFilename + ".json"
+
+    try:
+        info = probeDownload(url)
+    except Exception as e:
+        WARNING("Download failed: " + str(e))
+        return None
 
     try:
-        urllib.urlretrieve(url, completeFilename, reporthook=printProgress)
+        if info['ranges']:
+            state = None
+            if os.path.isfile(partFilename) and os.path.isfile(stateFilename):
+                try:
+                    with open(stateFilename) as f:
+                        state = json.load(f)
+                    if (state['url'], state['size'], state['etag'], state['lastModified']) != \
+                       (url, info['size'], info['etag'], info['lastModified']):
+                        state = None
+                except:
+                    state = None
+            if state is None:
+                if os.path.isfile(partFilename):
+                    os.remove(partFilename)
+                state = {'url': url,
+                         'size': info['size'],
+                         'etag': info['etag'],
+                         'lastModified': info['lastModified'],
+                         'chunks': splitDownloadRanges(info['size'], DOWNLOAD_CHUNK_COUNT)}
+            else:
+                INFO("Resuming the previous download of " + filename)
+            if not downloadRanges(url, partFilename, stateFilename, state,
+                                  lambda n: printProgress(n, info['size'])):
+                return None
+        else:
+            with open(partFilename, 'wb') as f:
+                downloadStream(url, f, lambda n: printProgress(n, info['size']))
     except KeyboardInterrupt:
         print "\b\b [INTERRUPTED]"
-        if os.path.isfile(completeFilename):
-            os.remove(completeFilename)
+        if not info['ranges'] and os.path.isfile(partFilename):
+            os.remove(partFilename)
+        return None
+    except Exception as e:
+        finishDownloadProgress()
+        WARNING("Download failed: " + str(e))
         return None
 
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+    finishDownloadProgress()
 
-    if saveToDisk == False:
-        content = ""
-        with open(completeFilename, 'r') as f:
-            content = f.read()
-        os.remove(completeFilename)
-        return content
-    else:
-        return completeFilename
+    def discardDownload(reason):
+        WARNING("The downloaded file is corrupted (" + reason + "), discarding it")
+        for f in (partFilename, stateFilename):
+            if os.path.isfile(f):
+                os.remove(f)
+        return False
+
+    # The '.part' file of a ranged download has its full size from the start,
+    # and the ranges not fetched yet are resumed by the next attempt
+    if info['ranges'] and not all(chunk[2] == chunk[1] - chunk[0] + 1 for chunk in state['chunks']):
+        WARNING("The download of " + filename + " is incomplete, resuming it")
+        return False
+    if info['size'] is not None and os.path.getsize(partFilename) != info['size']:
+        return discardDownload("size mismatch")
+    if sha256 is not None:
+        if computeFileHash(partFilename, 'sha256') != sha256.lower():
+            return discardDownload("SHA-256 mismatch")
+    elif info['md5'] is not None:
+        if computeFileHash(partFilename, 'md5') != base64.b64decode(info['md5']).encode('hex'):
+            return discardDownload("MD5 mismatch")
+    elif filename.lower().endswith('.zip') and not isValidZipFile(partFilename):
+        return discardDownload("zip CRC mismatch")
+
+    os.rename(partFilename, completeFilename)
+    if os.path.isfile(stateFilename):
+        os.remove(stateFilename)
+    return completeFilename
+
+
+'''
+    Local cache management functions
+'''
+# The cache keeps downloaded HAL packages and the results of the scraped ST web
+# pages. Packages are stored once per content hash under CACHE_BLOBS_DIR, the
+# index maps each URL to its blob (or to its scraped value, for pages) and
+# records when the entry was last used, for the LRU eviction
+def loadCacheIndex():
+    try:
+        with open(CACHE_INDEX_FILE) as f:
+            return json.load(f)
+    except:
+        return { 'entries': { } }
+
+def saveCacheIndex(index):
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    writeJSONAtomic(CACHE_INDEX_FILE, index)
+
+def getCacheBlobPath(entry):
+    return CACHE_BLOBS_DIR + "/" + entry['sha256'] + "/" + entry['filename']
+
+# Return the total size of the blobs referenced by the index
+def getCacheSize(index):
+    blobs = { }
+    for entry in index['entries'].values():
+        if entry['kind'] == 'package':
+            blobs[entry['sha256']] = entry['size']
+    return sum(blobs.values())
+
+# Remove the entry of 'url' from the index, and its blob from the disk if no
+# other URL references the same content
+def removeCacheEntry(index, url):
+    entry = index['entries'].pop(url)
+    if entry['kind'] != 'package':
+        return
+    for other in index['entries'].values():
+        if other['kind'] == 'package' and other['sha256'] == entry['sha256']:
+            return
+    if os.path.isdir(CACHE_BLOBS_DIR + "/" + entry['sha256']):
+        shutil.rmtree(CACHE_BLOBS_DIR + "/" + entry['sha256'])
+
+# Evict the least recently used packages until the cache fits its size limit.
+# The entry of 'keepURL' (the one just added) is never evicted
+def enforceCacheLimit(index, keepURL=None):
+    limit = int(getConfig('cacheSizeLimitMB')) * 1024 * 1024
+    packages = sorted([url for url in index['entries']
+                       if index['entries'][url]['kind'] == 'package' and url != keepURL],
+                      key=lambda url: index['entries'][url]['lastAccess'])
+    evicted = []
+    while getCacheSize(index) > limit and len(packages) > 0:
+        url = packages.pop(0)
+        removeCacheEntry(index, url)
+        evicted.append(url)
+    return evicted
+
+# Return the local path of the package at 'url', downloading it to the cache
+# only if it isn't already there. Returns None if the download fails.
+# Downloads of the same file are serialized with a lock on its name, since
+# they would share the '.part' file: a process that waits for another one
+# finds the package in the cache once it gets the lock
+def cacheFetchPackage(url):
+    with FileLock(CACHE_DOWNLOADS_DIR + "/" + url.split('/')[-1] + ".lock"):
+        with FileLock(CACHE_DIR + "/.lock"):
+            index = loadCacheIndex()
+            entry = index['entries'].get(url)
+            if entry is not None and entry['kind'] == 'package':
+                if os.path.isfile(getCacheBlobPath(entry)):
+                    INFO("Using the cached copy of " + entry['filename'])
+                    entry['lastAccess'] = time.time()
+                    saveCacheIndex(index)
+                    return getCacheBlobPath(entry)
+                removeCacheEntry(index, url)
+                saveCacheIndex(index)
+
+        downloaded = downloadFile(url, saveToDisk=True, location=CACHE_DOWNLOADS_DIR)
+        if downloaded is None:
+            return None
+
+        with FileLock(CACHE_DIR + "/.lock"):
+            index = loadCacheIndex()
+            entry = {
+                'kind': 'package',
+                'filename': os.path.basename(downloaded),
+                'sha256': computeFileHash(downloaded, 'sha256'),
+                'size': os.path.getsize(downloaded),
+                'lastAccess': time.time()
+            }
+            blobDir = CACHE_BLOBS_DIR + "/" + entry['sha256']
+            if os.path.isdir(blobDir) and len(os.listdir(blobDir)) > 0:
+                entry['filename'] = os.listdir(blobDir)[0]
+            blobPath = getCacheBlobPath(entry)
+            if os.path.isfile(blobPath):
+                os.remove(downloaded)
+            else:
+                if not os.path.isdir(os.path.dirname(blobPath)):
+                    os.makedirs(os.path.dirname(blobPath))
+                os.rename(downloaded, blobPath)
+            index['entries'][url] = entry
+            enforceCacheLimit(index, keepURL=url)
+            saveCacheIndex(index)
+        return blobPath
+
+# Return the cached entry of a scraped page (with its 'value' and the
+# 'validators' of the response it was scraped from), or None if the page
+# isn't cached. The 'fresh' field tells whether the entry is younger than the
+# 'cachePageTTL' option, otherwise the page should be revalidated
+def cacheGetPage(url):
+    with FileLock(CACHE_DIR + "/.lock"):
+        index = loadCacheIndex()
+        entry = index['entries'].get(url)
+        if entry is None or entry['kind'] != 'page':
+            return None
+        entry['lastAccess'] = time.time()
+        saveCacheIndex(index)
+        entry['fresh'] = time.time() - entry['created'] <= int(getConfig('cachePageTTL'))
+        return entry
+
+# Store the result of a scraped page
+def cacheStorePage(url, value, validators=None):
+    with FileLock(CACHE_DIR + "/.lock"):
+        index = loadCacheIndex()
+        now = time.time()
+        index['entries'][url] = { 'kind': 'page', 'value': value,
+                                  'validators': validators,
+                                  'created': now, 'lastAccess': now }
+        saveCacheIndex(index)
+
+# Print the content of the cache, most recently used first
+def listCache():
+    index = loadCacheIndex()
+    entries = sorted(index['entries'].items(), key=lambda e: -e[1]['lastAccess'])
+    if len(entries) == 0:
+        print "The cache is empty"
+        return
+    for url, entry in entries:
+        lastAccess = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry['lastAccess']))
+        if entry['kind'] == 'package':
+            print CLIFormat.ROWNAME + "[package]  " + CLIFormat.ENDF + "{} ({}, used {}) sha256:{}".format(entry['filename'], formatSize(entry['size']), lastAccess, entry['sha256'][:12])
+        else:
+            print CLIFormat.ROWNAME + "[page]     " + CLIFormat.ENDF + "{} (used {})".format(url, lastAccess)
+    print "Total: {} of {} MB".format(formatSize(getCacheSize(index)), getConfig('cacheSizeLimitMB'))
+
+# Drop expired pages, blobs no longer referenced and interrupted downloads,
+# then evict the least recently used packages beyond the size limit
+def pruneCache():
+    with FileLock(CACHE_DIR + "/.lock"):
+        index = loadCacheIndex()
+        removed = 0
+        for url in list(index['entries'].keys()):
+            entry = index['entries'][url]
+            if entry['kind'] == 'page':
+                if time.time() - entry['created'] > int(getConfig('cachePageTTL')):
+                    removeCacheEntry(index, url)
+                    removed += 1
+            elif not os.path.isfile(getCacheBlobPath(entry)):
+                removeCacheEntry(index, url)
+                removed += 1
+        removed += len(enforceCacheLimit(index))
+        saveCacheIndex(index)
+        referenced = set(e['sha256'] for e in index['entries'].values() if e['kind'] == 'package')
+        freed = 0
+        for d in (CACHE_BLOBS_DIR, CACHE_DOWNLOADS_DIR):
+            if not os.path.isdir(d): continue
+            for f in os.listdir(d):
+                if d == CACHE_BLOBS_DIR and f in referenced: continue
+                path = d + "/" + f
+                if d == CACHE_DOWNLOADS_DIR:
+                    # Keep the locks, and the files of downloads in progress
+                    if f.endswith(".lock"): continue
+                    lockFilename = d + "/" + re.sub(r'\.part(\.json)?$', '', f) + ".lock"
+                    if os.path.isfile(lockFilename):
+                        with FileLock(lockFilename, blocking=False) as lock:
+                            if not lock.acquired: continue
+                if os.path.isdir(path):
+                    freed += sum(os.path.getsize(os.path.join(root, name))
+                                 for root, dirs, files in os.walk(path) for name in files)
+                    shutil.rmtree(path)
+                else:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+    print "Removed {} entries, {} of orphaned files freed".format(removed, formatSize(freed))
 
 
 '''
     Templates management functions
 '''
-# Given a template "basename" (the name without extension of the local
-# template JSON and ZIP file), return the content of the JSON which provides
-# information about the given template
-def getTemplateInfo(basename):
+# The files of the templates are stored just once in TEMPLATES_BLOBS_DIR,
+# named after their SHA-256, so the files shared by different HAL versions and
+# series take space once. Each template has a manifest in
+# TEMPLATES_MANIFESTS_DIR mapping its paths to the blobs, while a single index
+# file, TEMPLATES_INDEX_FILE, maps each template "basename" (like
+# 'stm32f4-1.7.1') to its family, series, HAL version, the CMSIS models it
+# contains, its number of files and size. Return the index, moving the
+# templates left as ZIP archives by older versions to the blob store the first
+# time (unless 'migrate' is False, like when the templates lock is held)
+def loadTemplatesIndex(migrate=True):
+    try:
+        with open(TEMPLATES_INDEX_FILE) as f:
+            index = json.load(f)
+    except:
+        index = None
+    if migrate and (index is None or any(not 'files' in info for info in index.values())):
+        with FileLock(TEMPLATES_DIR + "/.lock"):
+            index = migrateTemplates()
+    return index if index is not None else { }
+
+def saveTemplatesIndex(index):
+    writeJSONAtomic(TEMPLATES_INDEX_FILE, index)
+
+# Move the templates stored as ZIP archives (with the per-template JSON files
+# of the oldest versions) to the blob store and return the updated index.
+# A template that can't be moved is left out of the index returned, but kept
+# in the saved one along with its archive, so that the next run retries.
+# Must be called while holding the templates lock
+def migrateTemplates():
+    index = loadTemplatesIndex(migrate=False)
+    archives = { }
+    if not os.path.isfile(TEMPLATES_INDEX_FILE) and os.path.isdir(TEMPLATES_DIR):
+        for f in sorted(os.listdir(TEMPLATES_DIR)):
+            legacyBasename, extension = os.path.splitext(f)
+            if extension != '.json' or not os.path.isfile(TEMPLATES_DIR + "/" + legacyBasename + ".zip"):
+                continue
+            try:
+                with open(TEMPLATES_DIR + "/" + f) as jsonFile:
+                    info = json.load(jsonFile)
+            except (IOError, ValueError):
+                continue
+            basename = legacyBasename + "-" + info['versionString']
+            index[basename] = info
+            archives[basename] = TEMPLATES_DIR + "/" + legacyBasename
+    failed = [ ]
+    for basename, info in index.items():
+        if 'files' in info: continue
+        archive = archives.get(basename, info.get('archive', TEMPLATES_DIR + "/" + basename))
+        if not os.path.isfile(archive + ".zip"):
+            WARNING("The archive of the template " + basename + " is missing, removing it")
+            del index[basename]
+            continue
+        try:
+            with zipfile.ZipFile(archive + ".zip") as zf:
+                names = zf.namelist()
+                manifest = storeTemplateFiles(zf, dict((n, n) for n in names if not n.endswith('/')),
+                                              [n.rstrip('/') for n in names if n.endswith('/')])
+        except (zipfile.BadZipfile, IOError, OSError) as e:
+            WARNING("Couldn't move the template " + basename + " to the new store (" + str(e) + "), it will be retried")
+            info['archive'] = archive
+            failed.append(basename)
+            continue
+        saveTemplateManifest(basename, manifest)
+        info.pop('archive', None)
+        info.update(getManifestSummary(manifest))
+        for extension in (".zip", ".json"):
+            if os.path.isfile(archive + extension):
+                os.remove(archive + extension)
+    shutil.rmtree(TEMPLATES_DIR + "/unpacked", ignore_errors=True)
+    if not os.path.isdir(TEMPLATES_DIR):
+        os.makedirs(TEMPLATES_DIR)
+    saveTemplatesIndex(index)
+    for basename in failed:
+        del index[basename]
+    return index
+
+def getTemplateBlobPath(sha256):
+    return TEMPLATES_BLOBS_DIR + "/" + sha256[:2] + "/" + sha256
+
+# Store the files of a template in the blob store. 'files' maps the paths of
+# the template to the members of the 'zf' ZIP archive, 'dirs' lists the
+# (possibly empty) directories. Return the manifest of the template
+def storeTemplateFiles(zf, files, dirs):
+    manifest = { 'files': { }, 'dirs': sorted(dirs) }
+    for path, member in files.items():
+        data = zf.read(member)
+        sha256 = hashlib.sha256(data).hexdigest()
+        blobPath = getTemplateBlobPath(sha256)
+        if os.path.isfile(blobPath):
+            # Tell a concurrent garbage collection that the blob is used again
+            os.utime(blobPath, None)
+        else:
+            if not os.path.isdir(os.path.dirname(blobPath)):
+                try:
+                    os.makedirs(os.path.dirname(blobPath))
+                except OSError:
+                    pass
+            # The blobs are shared by the linked projects, a write must fail
+            tempFilename = blobPath + ".tmp" + str(os.getpid())
+            with open(tempFilename, 'wb') as f:
+                f.write(data)
+            os.chmod(tempFilename, 0o444)
+            os.rename(tempFilename, blobPath)
+        manifest['files'][path] = [sha256, len(data)]
+    return manifest
+
+def loadTemplateManifest(basename):
     try:
-        with open(TEMPLATES_DIR + "/" + basename + ".json") as jsonFile:
-            return json.load(jsonFile)
+        with open(TEMPLATES_MANIFESTS_DIR + "/" + basename + ".json") as f:
+            return json.load(f)
     except:
         return None
 
-# Search for a compatible local template for the specified MCU family and series
-def getTemplateBasenameFor(familyID, seriesID):
-    for f in os.listdir(TEMPLATES_DIR):
-        if not os.path.isfile(TEMPLATES_DIR + "/" + f): continue
-        if f.split('.')[-1] == 'json':
-            basename = f.split('.')[0]
-            info = getTemplateInfo(basename)
-            if info is None: continue
-            if  (int(info['familyID']) == familyID) and \
-                (int(info['seriesID']) == seriesID):
-                return basename
-    return None
+def saveTemplateManifest(basename, manifest):
+    if not os.path.isdir(TEMPLATES_MANIFESTS_DIR):
+        os.makedirs(TEMPLATES_MANIFESTS_DIR)
+    writeJSONAtomic(TEMPLATES_MANIFESTS_DIR + "/" + basename + ".json", manifest)
+
+# Return the information about a template stored in the index
+def getManifestSummary(manifest):
+    return { 'models': getTemplateModels(manifest['files'].keys()),
+             'files': len(manifest['files']),
+             'size': sum(size for sha256, size in manifest['files'].values()) }
+
+# Return the CMSIS 'models' (like 'stm32f407xx') among the paths of a template
+def getTemplateModels(paths):
+    models = set()
+    for path in paths:
+        if not path.startswith("system/cmsis/"): continue
+        f = path.split('/')[-1]
+        if len(f.split('.')[0]) >= 11 and f[0:5].lower() == "stm32":
+            models.add(f.split('.')[0])
+    return sorted(models)
+
+# Given a template basename, return the information about the given
+# template from the index
+def getTemplateInfo(basename, index=None):
+    if index is None:
+        index = loadTemplatesIndex()
+    return index.get(basename)
+
+# Search for a compatible local template for the specified MCU family and
+# series, of the given HAL version string or otherwise the latest available
+def getTemplateBasenameFor(familyID, seriesID, versionString=None, index=None):
+    if index is None:
+        index = loadTemplatesIndex()
+    found = None
+    for basename, info in index.items():
+        if  (int(info['familyID']) != familyID) or \
+            (int(info['seriesID']) != seriesID):
+            continue
+        if versionString is not None and info['versionString'] != versionString:
+            continue
+        if found is None or int(info['versionNum']) > int(index[found]['versionNum']):
+            found = basename
+    return found
+
+# Tell if a file of a template (given its path inside the template) is
+# needed by a project for the 'modelFile' CMSIS model: the startup files and
+# device headers of the other models, and the HAL templates, are left out
+def isTemplateFileNeeded(path, modelFile):
+    parts = path.split('/')
+    f = parts[-1]
+    if len(parts) == 2 and parts[0] == "system" and "startup_" in f:
+        return f == "startup_" + modelFile + ".s"
+    if len(parts) == 3 and parts[:2] == ["system", "cmsis"] and "stm32" in f and len(f.split('.')[0]) >= 11:
+        return f == modelFile + ".h"
+    if len(parts) == 3 and parts[:2] == ["system", "hal"] and "_template" in f:
+        return False
+    return True
+
+# Populate the project directory with the files of a template needed by the
+# 'modelFile' model. With 'link' the 'system' files are hardlinked to the
+# (read-only) blobs instead of being copied, while the files meant to be
+# edited (like the HAL configuration header) are always copied. The 'manifest'
+# of the template is loaded if not given
+def materializeTemplate(basename, projectDir, modelFile, link=False, manifest=None):
+    if manifest is None:
+        manifest = loadTemplateManifest(basename)
+    for d in manifest['dirs']:
+        if not os.path.isdir(projectDir + "/" + d):
+            os.makedirs(projectDir + "/" + d)
+    for path, (sha256, size) in manifest['files'].items():
+        if not isTemplateFileNeeded(path, modelFile):
+            continue
+        dst = projectDir + "/" + path
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        if link and path.startswith("system/"):
+            linkFile(getTemplateBlobPath(sha256), dst)
+        else:
+            shutil.copyfile(getTemplateBlobPath(sha256), dst)
+
+# Write a template to a ZIP archive, the portable format of the templates
+def exportTemplate(basename, zipFilename):
+    manifest = loadTemplateManifest(basename)
+    allDirs = set(manifest['dirs'])
+    for path in manifest['files']:
+        parts = path.split('/')[:-1]
+        for i in range(len(parts)):
+            allDirs.add('/'.join(parts[:i + 1]))
+    zipHandle = zipfile.ZipFile(zipFilename, 'w', zipfile.ZIP_DEFLATED)
+    for d in sorted(allDirs):
+        dirInfo = zipfile.ZipInfo(d + '/')
+        dirInfo.external_attr = (0o40755 << 16) | 0x10
+        zipHandle.writestr(dirInfo, b'')
+    for path in sorted(manifest['files']):
+        fileInfo = zipfile.ZipInfo(path)
+        fileInfo.external_attr = 0o100644 << 16
+        fileInfo.compress_type = zipfile.ZIP_DEFLATED
+        with open(getTemplateBlobPath(manifest['files'][path][0]), 'rb') as f:
+            zipHandle.writestr(fileInfo, f.read())
+    zipHandle.close()
+
+# The projects are registered in PROJECTS_REGISTRY_FILE when created, so that
+# the garbage collection keeps the templates they were created from
+def registerProject(projectDir):
+    with FileLock(TEMPLATES_DIR + "/.lock"):
+        registry = loadProjectsRegistry()
+        if not os.path.abspath(projectDir) in registry:
+            registry.append(os.path.abspath(projectDir))
+            writeJSONAtomic(PROJECTS_REGISTRY_FILE, registry)
+
+def loadProjectsRegistry():
+    try:
+        with open(PROJECTS_REGISTRY_FILE) as f:
+            return json.load(f)
+    except:
+        return []
+
+# Return the templates used by the registered projects (basename -> list of
+# projects), dropping the projects that don't exist anymore from the registry.
+# Must be called while holding the templates lock
+def getProjectsTemplates():
+    registry = loadProjectsRegistry()
+    used = { }
+    for projectDir in list(registry):
+        try:
+            with open(projectDir + "/mcu.json") as f:
+                template = json.load(f).get('template')
+        except:
+            template = None
+        if template is None:
+            registry.remove(projectDir)
+        else:
+            used.setdefault(template, []).append(projectDir)
+    writeJSONAtomic(PROJECTS_REGISTRY_FILE, registry)
+    return used
+
+# Remove a template from the index. Its files are deleted by the garbage
+# collection, unless some registered project still uses it
+def removeTemplate(basename):
+    with FileLock(TEMPLATES_DIR + "/.lock"):
+        index = loadTemplatesIndex(migrate=False)
+        if not basename in index:
+            return False
+        del index[basename]
+        saveTemplatesIndex(index)
+    return True
+
+def listTemplates():
+    index = loadTemplatesIndex()
+    with FileLock(TEMPLATES_DIR + "/.lock"):
+        used = getProjectsTemplates()
+    if len(index) == 0 and len(used) == 0:
+        print "No local templates"
+        return
+    for basename in sorted(set(index) | set(used)):
+        projects = len(used.get(basename, []))
+        if basename in index:
+            info = index[basename]
+            details = "HAL {}, {} models, {} files, {}".format(info['versionString'], len(info['models']), info['files'], formatSize(info['size']))
+        else:
+            details = "removed"
+        if projects > 0:
+            details += ", used by {} projects".format(projects)
+        print CLIFormat.ROWNAME + "{:<18}".format(basename) + CLIFormat.ENDF + details
+    filesSize = 0
+    for basename in set(index) | set(used):
+        manifest = loadTemplateManifest(basename)
+        if manifest is not None:
+            filesSize += getManifestSummary(manifest)['size']
+    blobsSize = 0
+    for root, dirs, files in os.walk(TEMPLATES_BLOBS_DIR):
+        blobsSize += sum(os.path.getsize(root + "/" + f) for f in files)
+    print "Total: {} of files stored in {} of blobs, deduplication saved {}".format(
+          formatSize(filesSize), formatSize(blobsSize), formatSize(filesSize - blobsSize))
+
+# Delete the manifests of the templates that are neither in the index nor used
+# by a registered project, and then the blobs no manifest refers to
+def collectTemplatesGarbage():
+    removedTemplates = 0
+    removedBlobs = 0
+    removedLibs = 0
+    freed = 0
+    with FileLock(TEMPLATES_DIR + "/.lock"):
+        keep = set(loadTemplatesIndex(migrate=False)) | set(getProjectsTemplates())
+        referenced = set()
+        if os.path.isdir(TEMPLATES_MANIFESTS_DIR):
+            for f in os.listdir(TEMPLATES_MANIFESTS_DIR):
+                basename = os.path.splitext(f)[0]
+                if basename in keep:
+                    referenced.update(sha256 for sha256, size in loadTemplateManifest(basename)['files'].values())
+                else:
+                    os.remove(TEMPLATES_MANIFESTS_DIR + "/" + f)
+                    removedTemplates += 1
+        # Acquisitions store their blobs before taking the lock to add the
+        # manifest, so the recent blobs are left alone
+        for root, dirs, files in os.walk(TEMPLATES_BLOBS_DIR):
+            for f in files:
+                path = root + "/" + f
+                if f in referenced or time.time() - os.path.getmtime(path) < TEMPLATES_GC_GRACE_PERIOD:
+                    continue
+                freed += os.path.getsize(path)
+                os.remove(path)
+                removedBlobs += 1
+        # The prebuilt HAL libraries of the templates removed
+        if os.path.isdir(TEMPLATES_LIBS_DIR):
+            for f in os.listdir(TEMPLATES_LIBS_DIR):
+                path = TEMPLATES_LIBS_DIR + "/" + f
+                if getHALlibraryTemplate(f) in keep or time.time() - os.path.getmtime(path) < TEMPLATES_GC_GRACE_PERIOD:
+                    continue
+                freed += os.path.getsize(path)
+                os.remove(path)
+                removedLibs += 1
+    print "Removed {} templates, {} blobs and {} HAL libraries, {} freed".format(
+          removedTemplates, removedBlobs, removedLibs, formatSize(freed))
 
 
 '''
@@ -290,11 +1567,20 @@ def getHALDownloadLink(familyID, seriesID):
     familyLetter = 'F' if familyID == 0 else 'L'
     url = HAL_PACKAGE_PAGE_URL.format(familyLetter.lower(), seriesID)
 
-    response = downloadFile(url, saveToDisk=False)
+    cached = cacheGetPage(url)
+    if cached is not None and cached['fresh']:
+        return cached['value']
+
+    status, response, validators = downloadPage(url, cached.get('validators') if cached else None)
+    if status == 304:
+        cacheStorePage(url, cached['value'], validators)
+        return cached['value']
     if response is None:
         return None
     packagePageParser.feed(response)
 
+    if packagePageParser.downloadLink is not None:
+        cacheStorePage(url, packagePageParser.downloadLink, validators)
     return packagePageParser.downloadLink
 
 
@@ -322,9 +1608,12 @@ def getAvailableModels(projectDir):
 
 # Return the right CMSIS startup and include file for the specified MCU name
 def getModelFileForMCU(projectDir, mcuName):
+    return findModelForMCU(getAvailableModels(projectDir), mcuName)
+
+# Return the model among 'models' that matches the specified MCU name
+def findModelForMCU(models, mcuName):
     if mcuName in CMSIS_NAME_EXCEPTIONS:
         mcuName = CMSIS_NAME_EXCEPTIONS[mcuName]
-    models = getAvailableModels(projectDir)
     for model in models:
         if compareNames(model, mcuName):
             return model
@@ -341,55 +1630,307 @@ def getCMSISinclude(projectDir):
 '''
     MCU database management functions
 '''
-# Download the latest MCU database, parse it and save a local database
-# with just the useful fields (to reduce size and DB management complessity).
-# Return the new database JSON/dictionary object
-def updateMCUdatabase():
+# The local MCU database is an SQLite file, so that looking up a single part
+# doesn't require loading the whole database, and indexed searches by series,
+# flash and RAM size are possible
+class MCUDatabase:
 
-    def getColumnValue(row, columnID):
-        for cell in row['cells']:
-            if int(cell['columnId']) == columnID:
-                return cell['value']
-        return None
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS mcus ("
+                                "name TEXT PRIMARY KEY, family TEXT, series TEXT, "
+                                "flash INTEGER, ram INTEGER)")
+        # Databases created by older versions may lack the optional columns
+        existing = [row[1] for row in self.connection.execute("PRAGMA table_info(mcus)")]
+        for field, search, required in MCU_DB_COLUMNS:
+            if not field in existing:
+                columnType = "INTEGER" if field in MCU_DB_INTEGER_COLUMNS else "TEXT"
+                self.connection.execute("ALTER TABLE mcus ADD COLUMN " + field + " " + columnType)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS mcus_family ON mcus (family)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS mcus_series ON mcus (series)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS mcus_flash ON mcus (flash)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS mcus_ram ON mcus (ram)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
 
-    newDB = { }
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM mcus").fetchone()[0]
 
-    try:
-        stringData = downloadFile(MCU_DATABASE_URL, saveToDisk=False)
-        if stringData is None:
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __getitem__(self, name):
+        entry = self.get(name)
+        if entry is None:
+            raise KeyError(name)
+        return entry
+
+    def getFields(self):
+        return [field for field, search, required in MCU_DB_COLUMNS]
+
+    # Return the value stored under 'key' in the meta table, or None
+    def getMeta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def setMeta(self, key, value):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    # Return the age in seconds of the data, from the last time it was
+    # fetched from (or checked against) the ST website, None if unknown
+    def getAge(self):
+        fetchedAt = self.getMeta('fetchedAt')
+        return time.time() - fetchedAt if fetchedAt is not None else None
+
+    # True if the data is older than the 'mcuDBTTL' option
+    def isStale(self):
+        age = self.getAge()
+        return age is None or age > getConfig('mcuDBTTL')
+
+    # Return the entry of the MCU called 'name' (a dictionary with the fields
+    # of MCU_DB_COLUMNS), or None if it doesn't exist
+    def get(self, name):
+        fields = self.getFields()
+        row = self.connection.execute("SELECT " + ", ".join(fields) + " FROM mcus WHERE name = ?", (name,)).fetchone()
+        if row is None:
             return None
-        data = json.loads(stringData)
-        columnIDs = {'name': 1}
-        for column in data['columns']:
-            if "FLASH" in column['name']:
-                columnIDs['flash'] = int(column['id'])
-            if "RAM" in column['name']:
-                columnIDs['ram'] = int(column['id'])
-        if not all (key in columnIDs for key in ('flash', 'ram')):
+        return dict(zip(fields, row))
+
+    # Replace the whole content of the database with the 'entries' dictionary
+    # (MCU name -> { 'flash', 'ram', ... }), in a single transaction that
+    # also records when the entries were fetched (now, if not specified)
+    def replaceAll(self, entries, fetchedAt=None):
+        fields = self.getFields()
+        with self.connection:
+            self.connection.execute("DELETE FROM mcus")
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fetchedAt', ?)",
+                                    (json.dumps(fetchedAt if fetchedAt is not None else time.time()),))
+            self.connection.executemany("INSERT OR REPLACE INTO mcus (name, family, series, " + ", ".join(fields) + ") "
+                                        "VALUES (" + ", ".join(['?'] * (len(fields) + 3)) + ")",
+                                        ([name, name[:6], name[:7]] + [entry.get(field) for field in fields]
+                                         for name, entry in entries.items()))
+
+    # Return the entries (with their 'name') of the MCUs whose name matches
+    # 'pattern' (a prefix, or a pattern with '*' and '?' wildcards), within
+    # the given flash and RAM ranges (in kB, None for no limit), sorted by name
+    def search(self, pattern, minFlash=None, maxFlash=None, minRAM=None, maxRAM=None):
+        fields = ['name'] + self.getFields()
+        pattern = pattern.upper()
+        if not '*' in pattern and not '?' in pattern:
+            pattern += '*'
+        query = "SELECT " + ", ".join(fields) + " FROM mcus WHERE name GLOB ?"
+        params = [pattern]
+        for condition, value in (("flash >= ?", minFlash), ("flash <= ?", maxFlash),
+                                 ("ram >= ?", minRAM), ("ram <= ?", maxRAM)):
+            if value is not None:
+                query += " AND " + condition
+                params.append(value)
+        return [dict(zip(fields, row)) for row in self.connection.execute(query + " ORDER BY name", params)]
+
+# Extracts the values of some columns from the rows of the ST product grid.
+# Every row has a 'cells' list of { 'columnId', 'value' } objects, usually in
+# the same order, so the position of each wanted column is resolved on the
+# first row that has all of them and then just checked on the following ones.
+# Rows with a different layout (or before the positions are known) are read
+# with a single pass over their cells
+class GridRowExtractor:
+
+    def __init__(self, columnIDs):
+        self.columnIDs = columnIDs
+        self.fieldsByID = dict((columnID, field) for field, columnID in columnIDs.items())
+        self.positions = None
+
+    def extract(self, row):
+        cells = row['cells']
+        raw = None
+        if self.positions is not None:
+            try:
+                raw = { }
+                for field, position in self.positions:
+                    cell = cells[position]
+                    if int(cell['columnId']) != self.columnIDs[field]:
+                        raw = None
+                        break
+                    raw[field] = cell['value']
+            except IndexError:
+                raw = None
+        if raw is None:
+            raw = { }
+            positions = []
+            for position in range(len(cells)):
+                field = self.fieldsByID.get(int(cells[position]['columnId']))
+                if field is not None:
+                    raw[field] = cells[position]['value']
+                    positions.append((field, position))
+            # A row without some optional column can't give its position
+            if self.positions is None and len(positions) == len(self.columnIDs):
+                self.positions = positions
+        return self.convert(raw)
+
+    # Convert the raw values to the database entry, or None if a required
+    # value is missing or invalid
+    def convert(self, raw):
+        if raw.get('name') is None:
             return None
-        for row in data['rows']:
+        values = { 'name': raw['name'] }
+        for field, search, required in MCU_DB_COLUMNS:
+            value = raw.get(field)
+            if value is not None and field in MCU_DB_INTEGER_COLUMNS:
+                try:
+                    value = int(float(value))
+                except ValueError:
+                    value = None
+            if value is None and required:
+                return None
+            values[field] = value
+        return values
+
+# Download the latest MCU database, parse it and save a local database
+# with just the useful fields (to reduce size and DB management complessity).
+# The product grid is parsed while it's downloaded, one row at a time.
+# Concurrent updates (like a background one) are serialized with a lock.
+# Return the new database object
+def updateMCUdatabase():
+    with FileLock(MCU_DB_LOCK_FILE):
+        validators = None
+        if os.path.isfile(MCU_DB_FILE):
             try:
-                name = getColumnValue(row, columnIDs['name'])
-                flashSize = getColumnValue(row, columnIDs['flash'])
-                ramSize = getColumnValue(row, columnIDs['ram'])
-                if not None in (name, flashSize, ramSize):
-                    newDB[name] = { 'flash': flashSize, 'ram': ramSize }
+                with open(MCU_DB_HTTP_FILE) as f:
+                    validators = json.load(f)
             except:
                 pass
-        with open(MCU_DB_FILE, 'w') as dbJSONFile:
-            json.dump(newDB, dbJSONFile)
-        return newDB
-    except:
-        return None
 
-# Load the local DB and return the JSON/dictionary object
+        try:
+            status, stream, validators = openPage(MCU_DATABASE_URL, validators)
+            if status == 304:
+                print "The local MCU database is already up to date"
+                mcuDB = loadMCUdatabase()
+                if mcuDB is not None:
+                    mcuDB.setMeta('fetchedAt', time.time())
+                return mcuDB
+
+            columnIDs = None
+            pendingRows = []
+            extractor = None
+            newDB = { }
+
+            def addRow(row):
+                values = extractor.extract(row)
+                if values is not None:
+                    newDB[values['name']] = values
+
+            for key, value in iterJSONObjectMembers(stream, ('rows',)):
+                if key == 'columns':
+                    columnIDs = {'name': 1}
+                    for column in value:
+                        for field, search, required in MCU_DB_COLUMNS:
+                            if search in column['name']:
+                                columnIDs[field] = int(column['id'])
+                    if not all(field in columnIDs for field, search, required in MCU_DB_COLUMNS if required):
+                        stream.close()
+                        WARNING("The MCU database downloaded lacks some required columns")
+                        return None
+                    extractor = GridRowExtractor(columnIDs)
+                    for row in pendingRows:
+                        addRow(row)
+                    pendingRows = []
+                elif key == 'rows':
+                    # Rows are kept aside only if they come before the columns
+                    if extractor is None:
+                        pendingRows.append(value)
+                    else:
+                        addRow(value)
+            stream.close()
+            if extractor is None:
+                WARNING("The MCU database downloaded has no columns")
+                return None
+
+            mcuDB = MCUDatabase(MCU_DB_FILE)
+            mcuDB.replaceAll(newDB)
+            writeJSONAtomic(MCU_DB_HTTP_FILE, validators)
+            return mcuDB
+        except (IOError, OSError, ValueError, sqlite3.Error, httplib.HTTPException) as e:
+            WARNING("Couldn't update the MCU database: " + (str(e) or e.__class__.__name__))
+            return None
+
+# Load the local DB and return the database object, or None if there's no
+# local database. A database left by older versions in the JSON format is
+# converted on the first load
 def loadMCUdatabase():
     try:
-        with open(MCU_DB_FILE) as datafile:
-            return json.load(datafile)
+        if not os.path.isfile(MCU_DB_FILE):
+            if not os.path.isfile(MCU_DB_LEGACY_FILE):
+                return None
+            with open(MCU_DB_LEGACY_FILE) as datafile:
+                legacyDB = json.load(datafile)
+            entries = { }
+            for name in legacyDB:
+                try:
+                    entries[name] = { 'flash': int(legacyDB[name]['flash']),
+                                      'ram': int(legacyDB[name]['ram']) }
+                except:
+                    pass
+            MCUDatabase(MCU_DB_FILE).replaceAll(entries, os.path.getmtime(MCU_DB_LEGACY_FILE))
+            os.remove(MCU_DB_LEGACY_FILE)
+        mcuDB = MCUDatabase(MCU_DB_FILE)
+        return mcuDB if len(mcuDB) > 0 else None
     except:
         return None
 
+# Start a detached 'db update' process that refreshes the MCU database while
+# the current command goes on with the local data. Its output goes to
+# MCU_DB_LOG_FILE. Return False if an update is already running
+def refreshMCUdatabaseInBackground():
+    with FileLock(MCU_DB_LOCK_FILE, blocking=False) as lock:
+        if not lock.acquired:
+            return False
+    with open(os.devnull) as devnull, open(MCU_DB_LOG_FILE, 'a') as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'db', 'update'],
+                         stdin=devnull, stdout=log, stderr=subprocess.STDOUT,
+                         close_fds=True, preexec_fn=os.setsid)
+    return True
+
+# Refresh the MCU database in background if it's older than 'mcuDBTTL'
+def refreshMCUdatabaseIfStale(mcuDB):
+    if mcuDB.isStale() and refreshMCUdatabaseInBackground():
+        print "The local MCU database is outdated, updating it in background"
+
+# Print the local MCU database status
+def printMCUdatabaseStatus():
+    mcuDB = loadMCUdatabase()
+    if mcuDB is None:
+        print "No local MCU database found"
+        return
+    age = mcuDB.getAge()
+    print CLIFormat.ROWNAME + "[MCUs]     " + CLIFormat.ENDF + str(len(mcuDB))
+    if age is None:
+        print CLIFormat.ROWNAME + "[Updated]  " + CLIFormat.ENDF + "unknown"
+    else:
+        print CLIFormat.ROWNAME + "[Updated]  " + CLIFormat.ENDF + "{:.1f} days ago".format(age / 86400)
+    print CLIFormat.ROWNAME + "[TTL]      " + CLIFormat.ENDF + "{:.1f} days{}".format(getConfig('mcuDBTTL') / 86400.0, " (outdated)" if mcuDB.isStale() else "")
+
+# Print the MCUs of the local database that match the search parameters
+def searchMCUdatabase(pattern, minFlash=None, maxFlash=None, minRAM=None, maxRAM=None):
+    mcuDB = loadMCUdatabase()
+    if mcuDB is None:
+        print "No local MCU database found, downloading now"
+        mcuDB = updateMCUdatabase()
+        if mcuDB is None:
+            ERROR("Couldn't load or update the database")
+    else:
+        refreshMCUdatabaseIfStale(mcuDB)
+    startTime = time.time()
+    results = mcuDB.search(pattern, minFlash, maxFlash, minRAM, maxRAM)
+    elapsed = time.time() - startTime
+    for entry in results:
+        details = "FLASH={}kB, RAM={}kB".format(entry['flash'], entry['ram'])
+        if entry['core'] is not None: details += ", " + entry['core']
+        if entry['frequency'] is not None: details += " @ {}MHz".format(entry['frequency'])
+        if entry['package'] is not None: details += ", " + entry['package']
+        print CLIFormat.ROWNAME + "{:<14}".format(entry['name']) + CLIFormat.ENDF + details
+    print "{} MCUs found ({:.1f} ms)".format(len(results), elapsed * 1000)
+
 
 '''
     MCU object class
@@ -409,6 +1950,7 @@ class MCU:
         self.cpuName = ''
         self.iset = 'thumb'
         self.fpu = False
+        self.template = None
 
     # Static function to get the MCU family and series just from the name
     # Even a partial name would work, like 'STM32F3'
@@ -492,6 +2034,8 @@ class MCU:
         export = {  'name': self.name,
                     'flash': self.flash,
                     'ram': self.ram }
+        if self.template is not None:
+            export['template'] = self.template
         with open(filename, 'w') as JSONFile:
             json.dump(export, JSONFile)
 
@@ -501,46 +2045,1310 @@ class MCU:
             self.loadFromName(data['name'])
             self.flash = data['flash']
             self.ram = data['ram']
+            self.template = data.get('template')
 
     def __str__(self):
         return "\"" + self.name + "\": " + self.cpuName.upper() + "(" + str(self.cpuID) + "), FLASH=" + str(self.flash) + "kB, RAM=" + str(self.ram) + "kB, FPU=" + str(self.fpu) + ", Iset='" + self.iset + "'"
 
 
 '''
-    SUBPROGRAM: Project compilation script
+    HAL sources analysis functions
 '''
-def parseMakeOutput(out):
-    lines = out.splitlines()[-4:]
-    sizeLine = None
-    for i in range(len(lines)):
-        line = lines[i]
-        if 'bss' in line and 'data' in line:
-            sizeLine = lines[i + 1]
-    if sizeLine is None:
-        return None
-    tokens = sizeLine.split()
-    result = {  'text': int(tokens[0]),
-                'data': int(tokens[1]),
-                'bss':  int(tokens[2]) }
-    return result
+# The HAL sources compiled with a project are only the ones of the modules it
+# uses. Starting from the sources of the project (everything but the HAL
+# directory), the '#include' edges are followed and the HAL functions and
+# macros referenced (like 'HAL_GPIO_Init' or '__HAL_RCC_GPIOA_CLK_ENABLE') are
+# collected, then the same is done on the sources of each module found.
+# The includes of the HAL configuration header are not followed, since it
+# includes the headers of all the enabled modules
 
-def compileProject(projectDir):
-    command = ['make', '-j' + str(getCPUcount() + 1)]
-    makeProcess = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE, cwd=projectDir)
-    out, err = makeProcess.communicate()
-    if makeProcess.returncode != 0:
-        return (False, err)
+# Return the #include directives (as "name" or <name>) and the HAL modules
+# referenced in a file
+def scanSourceFile(filename):
+    with open(filename) as f:
+        content = f.read()
+    includes = re.findall(r'^\s*#\s*include\s*([<"][^>"]+[>"])', content, re.MULTILINE)
+    modules = set()
+    for module in re.findall(r'HAL_([A-Z0-9]+?)(?:Ex)?_(?!MODULE_ENABLED)', content):
+        module = module.lower()
+        modules.add("hal_" + HAL_MODULE_ALIASES.get(module, module))
+    return { 'includes': includes, 'modules': sorted(modules) }
+
+# Return the HAL module of a file, like 'hal_rcc' for 'stm32f4xx_hal_rcc_ex.c',
+# or None if it's not part of a module (like the HAL core or the LL drivers)
+def getHALfileModule(filename):
+    match = re.match(r'^stm32\w+?xx_hal_([a-z0-9]+)\w*\.[ch]$', filename)
+    return "hal_" + match.group(1) if match is not None else None
+
+# Return the HAL modules enabled in the HAL configuration header, or None if
+# it can't be read
+def getEnabledHALmodules(confFilename):
+    try:
+        with open(confFilename) as f:
+            content = f.read()
+    except IOError:
+        return None
+    return set("hal_" + m.lower() for m in re.findall(r'^\s*#\s*define\s+HAL_(\w+)_MODULE_ENABLED\b', content, re.MULTILINE))
+
+# Return the list of the HAL sources used by the project, or None if the
+# project doesn't have a HAL directory. The include graph is cached in the
+# project, and each file is scanned again only when it changes
+def findUsedHALsources(projectDir):
+    dirs = loadMakeVariables(projectDir + "/dirs.mk").get('DIRS', '').split()
+    halDir = "system/hal"
+    if not halDir in dirs:
+        return None
+    cacheFilename = projectDir + "/" + PROJECT_TOOL_DIR + "/include_graph.json"
+    try:
+        with open(cacheFilename) as f:
+            cache = json.load(f)
+    except:
+        cache = { }
+    graph = { }
+
+    def getNode(path):
+        stat = os.stat(projectDir + "/" + path)
+        key = [stat.st_mtime, stat.st_size]
+        node = cache.get(path)
+        if node is None or node['key'] != key:
+            node = scanSourceFile(projectDir + "/" + path)
+            node['key'] = key
+        graph[path] = node
+        return node
+
+    def resolveInclude(path, include):
+        candidates = dirs
+        if include[0] == '"':
+            candidates = [os.path.dirname(path)] + dirs
+        for d in candidates:
+            includePath = os.path.normpath(os.path.join(d, include[1:-1]))
+            if os.path.isfile(projectDir + "/" + includePath):
+                return includePath
+        return None
+
+    # The sources of each HAL module
+    moduleFiles = { }
+    confFilename = None
+    for d in dirs:
+        if not os.path.isdir(projectDir + "/" + d): continue
+        for f in sorted(os.listdir(projectDir + "/" + d)):
+            if f.endswith("_hal_conf.h"):
+                confFilename = d + "/" + f
+            module = getHALfileModule(f) if d == halDir else None
+            if module is not None and f.endswith('.c'):
+                moduleFiles.setdefault(module, []).append(d + "/" + f)
+    enabledModules = getEnabledHALmodules(projectDir + "/" + confFilename) if confFilename else None
+
+    # The analysis starts from all the sources but the ones of the HAL modules
+    usedModules = set()
+    pending = [d + "/" + f for d in dirs if os.path.isdir(projectDir + "/" + d)
+               for f in sorted(os.listdir(projectDir + "/" + d))
+               if f.endswith('.c') and (d != halDir or getHALfileModule(f) is None)]
+    sources = set(path for path in pending if path.startswith(halDir + "/"))
+    visited = set()
+    while len(pending) > 0:
+        path = pending.pop()
+        if path in visited:
+            continue
+        visited.add(path)
+        node = getNode(path)
+        referenced = []
+        module = getHALfileModule(os.path.basename(path))
+        if module is not None:
+            referenced.append(module)
+        # The HAL headers and the configuration header would bring in every module
+        if not (path.startswith(halDir + "/") and path.endswith('.h')) and path != confFilename:
+            referenced += node['modules']
+        if path != confFilename:
+            for include in node['includes']:
+                includePath = resolveInclude(path, include)
+                if includePath is not None:
+                    pending.append(includePath)
+        for module in referenced:
+            if module in moduleFiles and not module in usedModules:
+                if enabledModules is not None and not module in enabledModules:
+                    continue
+                usedModules.add(module)
+                pending += moduleFiles[module]
+
+    if not os.path.isdir(projectDir + "/" + PROJECT_TOOL_DIR):
+        os.makedirs(projectDir + "/" + PROJECT_TOOL_DIR)
+    writeJSONAtomic(cacheFilename, graph)
+    for module in usedModules:
+        sources.update(moduleFiles[module])
+    return sorted(sources)
+
+# Return what a C source defines and uses at file scope, to tell if it can
+# share a translation unit with other sources:
+#  - 'names' maps the names defined that may clash with the ones of another
+#    source to their definition: the parameters and body of the macros, or
+#    None for the static functions and variables and the types, which clash
+#    with any other definition. The include guards are left out
+#  - 'macros' has the macros defined (but the include guards) or undefined,
+#    which change the meaning of the sources that follow in the same unit
+#  - 'uses' has the identifiers used, but the macros the source defines
+def getUnitySymbols(filename):
+    with open(filename) as f:
+        content = f.read()
+    content = re.sub(r'/\*.*?\*/', ' ', content, flags=re.DOTALL)
+    content = re.sub(r'//[^\n]*', '', content)
+    content = content.replace('\\\n', ' ')
+    content = re.sub(r'"(\\.|[^"\\\n])*"|\'(\\.|[^\'\\\n])*\'', '""', content)
+    guards = set(re.findall(r'^[ \t]*#[ \t]*ifndef[ \t]+(\w+)[ \t]*\n[ \t]*#[ \t]*define[ \t]+\1[ \t]*$', content, re.MULTILINE))
+    names = { }
+    for name, parameters, body in re.findall(r'^[ \t]*#[ \t]*define[ \t]+(\w+)(\([^)\n]*\))?(.*)$', content, re.MULTILINE):
+        if not name in guards:
+            names[name] = re.sub(r'\s+', '', parameters) + ' ' + ' '.join(body.split())
+    macros = set(names) | set(re.findall(r'^[ \t]*#[ \t]*undef[ \t]+(\w+)', content, re.MULTILINE))
+    uses = set(re.findall(r'\b[A-Za-z_]\w*', content)) - set(names) - guards
+    for name in re.findall(r'^static\b[^;{}=(]*?\b(\w+)\s*[\[(=;,]', content, re.MULTILINE) + \
+                re.findall(r'^typedef\b[^;{]*?\b(\w+)\s*;', content, re.MULTILINE) + \
+                re.findall(r'^}\s*(\w+)\s*;', content, re.MULTILINE):
+        names[name] = None
+    return { 'names': names, 'macros': macros, 'uses': uses }
+
+# Tell if the sources with the given symbols (see getUnitySymbols()) can't be
+# in the same translation unit. A macro can be defined again with the same
+# definition, any other name defined twice is a clash, and so is a macro
+# defined or undefined by a source with the same name as an identifier used
+# by the other one
+def unitySymbolsClash(symbols, otherSymbols):
+    names, otherNames = symbols['names'], otherSymbols['names']
+    if len(names) > len(otherNames):
+        names, otherNames = otherNames, names
+    if any(name in otherNames and (definition is None or otherNames[name] != definition)
+           for name, definition in names.items()):
+        return True
+    return len(symbols['macros'] & otherSymbols['uses']) > 0 or \
+           len(otherSymbols['macros'] & symbols['uses']) > 0
+
+# Group the sources of a unity build in 'batches' translation units, balancing
+# their size. Two sources whose symbols clash never go in the same batch, and
+# a source clashing with all the batches is compiled alone.
+# Returns the list of the batches, each a list of sources
+def groupUnitySources(projectDir, sources, batches):
+    sizes = dict((source, os.path.getsize(projectDir + "/" + source)) for source in sources)
+    symbols = dict((source, getUnitySymbols(projectDir + "/" + source)) for source in sources)
+    groups = [[] for i in range(batches)]
+    groupsSymbols = [{ 'names': { }, 'macros': set(), 'uses': set() } for i in range(batches)]
+    groupsSize = [0] * batches
+    isolated = []
+    for source in sorted(sources, key=lambda source: (-sizes[source], source)):
+        candidates = [i for i in range(batches) if not unitySymbolsClash(groupsSymbols[i], symbols[source])]
+        if len(candidates) == 0:
+            isolated.append([source])
+            continue
+        i = min(candidates, key=lambda i: groupsSize[i])
+        groups[i].append(source)
+        groupsSymbols[i]['names'].update(symbols[source]['names'])
+        groupsSymbols[i]['macros'] |= symbols[source]['macros']
+        groupsSymbols[i]['uses'] |= symbols[source]['uses']
+        groupsSize[i] += sizes[source]
+    return [sorted(group) for group in groups if len(group) > 0] + isolated
+
+# Return the number of unity translation units for the HAL set by
+# HAL_UNITY_BATCHES in the project config.mk ('auto' for one per CPU core),
+# or 0 if the HAL sources are compiled one by one
+def getUnityBatches(projectDir):
+    try:
+        value = loadMakeVariables(projectDir + "/config.mk").get('HAL_UNITY_BATCHES', '').strip()
+    except IOError:
+        return 0
+    if value == 'auto':
+        return getCPUcount()
+    return int(value) if value.isdigit() else 0
+
+# Write the content of a generated file only if it changed, so that 'make'
+# doesn't rebuild what depends on it
+def writeFileIfChanged(filename, content):
+    try:
+        with open(filename) as f:
+            if f.read() == content:
+                return
+    except IOError:
+        pass
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+        f.write(content)
+
+# Write the sources of a unity build of the HAL in HAL_UNITY_DIR, each
+# including a batch of HAL sources. Returns the list of the sources to compile
+def writeUnitySources(projectDir, sources, batches):
+    compiled = []
+    unityFiles = set()
+    for group in groupUnitySources(projectDir, sources, batches):
+        if len(group) == 1:
+            compiled.append(group[0])
+            continue
+        filename = HAL_UNITY_DIR + "/hal_unity_{}.c".format(len(unityFiles) + 1)
+        content = "/* Generated by stm32tool, unity build of a batch of HAL sources */\n"
+        for source in group:
+            content += '#include "{}"\n'.format(os.path.relpath(source, HAL_UNITY_DIR))
+            # The macros of a source must not reach the next ones
+            if source != group[-1]:
+                names = getUnitySymbols(projectDir + "/" + source)['names']
+                content += "".join("#undef {}\n".format(name) for name in sorted(names) if names[name] is not None)
+        writeFileIfChanged(projectDir + "/" + filename, content)
+        unityFiles.add(filename)
+        compiled.append(filename)
+    # The batches of a previous build with more of them
+    for f in os.listdir(projectDir + "/" + HAL_UNITY_DIR) if os.path.isdir(projectDir + "/" + HAL_UNITY_DIR) else []:
+        if not HAL_UNITY_DIR + "/" + f in unityFiles:
+            os.remove(projectDir + "/" + HAL_UNITY_DIR + "/" + f)
+    return sorted(compiled)
+
+# Write the list of the HAL sources used by the project to HAL_SOURCES_MK,
+# which the Makefile reads instead of compiling the whole HAL directory. With
+# HAL_UNITY_BATCHES set, the HAL sources are compiled in unity batches.
+# Returns the list of the HAL sources to compile, or None if they can't be
+# pruned
+def writeHALsourcesList(projectDir):
+    try:
+        sources = findUsedHALsources(projectDir)
+        batches = getUnityBatches(projectDir)
+        if sources is not None and batches > 0:
+            sources = writeUnitySources(projectDir, sources, batches)
+    except (IOError, OSError):
+        sources = None
+    if sources is None:
+        return None
+    content = "# Generated by stm32tool, the HAL sources used by the project\n"
+    content += "HAL_SOURCES = " + " \\\n    ".join(sources) + "\n"
+    writeFileIfChanged(projectDir + "/" + HAL_SOURCES_MK, content)
+    return sources
+
+
+'''
+    Prebuilt HAL libraries functions
+'''
+# The HAL sources used by the projects of a template are compiled once for
+# each configuration (CPU, flags, HAL configuration header, content of the
+# system files, HAL sources used, ...) and archived in TEMPLATES_LIBS_DIR as
+# libhal_<template>-<hash>.a, so that the projects with the same configuration
+# link the library instead of compiling the HAL
+
+# Return the hash of the sources and headers under the system directory of a
+# project (HAL, CMSIS, ...), which are compiled into the HAL library and may
+# have been patched by the user. The hash of each file is remembered in
+# SYSTEM_HASHES_FILE by size and modification time, so that only the files
+# changed since the last build are read again
+def getSystemFilesHash(projectDir):
+    try:
+        with open(projectDir + "/" + SYSTEM_HASHES_FILE) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = { }
+    hashes = { }
+    for root, dirs, files in os.walk(projectDir + "/system"):
+        for name in files:
+            if not os.path.splitext(name)[1] in ('.c', '.h'):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            filename = os.path.relpath(path, projectDir)
+            key = [stat.st_size, stat.st_mtime]
+            if filename in cache and cache[filename][:2] == key:
+                hashes[filename] = cache[filename]
+            else:
+                hashes[filename] = key + [computeFileHash(path)]
+    if hashes != cache:
+        try:
+            if not os.path.isdir(projectDir + "/" + PROJECT_TOOL_DIR):
+                os.makedirs(projectDir + "/" + PROJECT_TOOL_DIR)
+            writeJSONAtomic(projectDir + "/" + SYSTEM_HASHES_FILE, hashes)
+        except (IOError, OSError):
+            pass
+    keyHash = hashlib.sha256()
+    for filename in sorted(hashes):
+        keyHash.update(filename + '\0' + hashes[filename][2] + '\0')
+    return keyHash.hexdigest()
+
+# Return the path of the HAL library matching the configuration of a project,
+# with the make 'variables' given on the command line and the 'halSources'
+# compiled (see writeHALsourcesList(), None for the whole HAL). The library
+# may not be built yet. Returns None if the project can't use one
+def getHALlibraryPath(projectDir, variables=None, halSources=None):
+    try:
+        with open(projectDir + "/mcu.json") as f:
+            template = json.load(f).get('template')
+        with open(projectDir + "/Makefile") as f:
+            supported = "hal-lib:" in f.read()
+        config = loadMakeVariables(projectDir + "/config.mk")
+        config.update(variables or { })
+        variables = loadMakeVariables(projectDir + "/Makefile", config)
+        dirs = loadMakeVariables(projectDir + "/dirs.mk").get('DIRS', '').split()
+        compilerVersion = getCompilerVersion('arm-none-eabi-gcc')
+        if template is None or not supported or not "system/hal" in dirs:
+            return None
+        systemHash = getSystemFilesHash(projectDir)
+    except (IOError, OSError, ValueError):
+        return None
+    keyHash = hashlib.sha256()
+    keyHash.update(compilerVersion + '\0')
+    for name in ('CPU', 'ISET', 'FLAGS'):
+        keyHash.update(variables.get(name, '') + '\0')
+    keyHash.update(' '.join(dirs) + '\0')
+    keyHash.update(systemHash + '\0')
+    keyHash.update(' '.join(halSources) + '\0' if halSources is not None else '*\0')
+    # The unity batches are generated, so they aren't in the system files
+    for source in halSources or []:
+        if source.startswith(HAL_UNITY_DIR + "/"):
+            with open(projectDir + "/" + source) as f:
+                keyHash.update(f.read())
+    # The HAL configuration header belongs to the project and can be changed
+    for d in dirs:
+        for filename in sorted(glob.glob(projectDir + "/" + d + "/*_hal_conf.h")):
+            with open(filename) as f:
+                keyHash.update(f.read())
+    return TEMPLATES_LIBS_DIR + "/libhal_" + template + "-" + keyHash.hexdigest()[:16] + ".a"
+
+# Return the template a HAL library file name was built from
+def getHALlibraryTemplate(filename):
+    return filename[len("libhal_"):].rsplit('-', 1)[0]
+
+# Build the HAL library of a project to 'libPath', through the 'hal-lib'
+# target of the project Makefile and the 'make' command line (and environment)
+# given. The projects building the same library at the same time wait for the
+# first one to finish. Returns True if the library has been built
+def buildHALlibrary(projectDir, libPath, command, env=None):
+    with FileLock(libPath + ".lock"):
+        if os.path.isfile(libPath):
+            return True
+        tempFilename = libPath + ".tmp" + str(os.getpid())
+        FNULL = open(os.devnull, 'w')
+        makeProcess = subprocess.Popen(command + ['hal-lib', 'HAL_LIB_OUT=' + tempFilename],
+                                       stdout=FNULL, stderr=subprocess.STDOUT, cwd=projectDir, env=env)
+        if makeProcess.wait() != 0 or not os.path.isfile(tempFilename):
+            if os.path.isfile(tempFilename):
+                os.remove(tempFilename)
+            return False
+        os.rename(tempFilename, libPath)
+    return True
+
+
+'''
+    Object cache functions
+'''
+# The objects compiled by the projects are cached in OBJCACHE_DIR, so that the
+# same translation unit (like a HAL source compiled with the same flags by
+# many projects) is compiled once. The key of an object is the hash of the
+# compiler version, the flags and the preprocessed source. The project
+# Makefile runs the compiler through TOOLWRAPPER, which compileProject sets to
+# the 'cc-wrapper' mode of the tool
+
+def getObjcachePaths(key):
+    base = OBJCACHE_DIR + "/" + key[:2] + "/" + key
+    return (base + ".o", base + ".log")
+
+# Return the version of a compiler, as printed by '--version'. Running the
+# compiler costs about as much as a small compilation, so the versions are
+# remembered in COMPILERS_FILE by path, size and modification time
+def getCompilerVersion(compiler):
+    paths = [compiler] if os.sep in compiler else \
+            [os.path.join(d, compiler) for d in os.environ.get('PATH', '').split(os.pathsep)]
+    path = next((os.path.abspath(p) for p in paths if os.path.isfile(p) and os.access(p, os.X_OK)), None)
+    try:
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime]
+    except (OSError, TypeError):
+        key = None
+    try:
+        with open(COMPILERS_FILE) as f:
+            versions = json.load(f)
+    except (IOError, ValueError):
+        versions = { }
+    if key is not None and path in versions and versions[path][:2] == key:
+        return versions[path][2]
+    versionProcess = subprocess.Popen([compiler, '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    version = versionProcess.communicate()[0].split('\n')[0]
+    if key is not None and versionProcess.returncode == 0:
+        versions[path] = key + [version]
+        try:
+            if not os.path.isdir(TOOL_DIR):
+                os.makedirs(TOOL_DIR)
+            writeJSONAtomic(COMPILERS_FILE, versions)
+        except (IOError, OSError):
+            pass
+    return version
+
+# Count a hit or a miss (with the size of the object added) of the object
+# cache. Each access is a single append to a log, so the compilations running
+# at the same time don't need to take a lock
+def countObjcacheAccess(hit, size=0):
+    with open(OBJCACHE_HITS_FILE if hit else OBJCACHE_MISSES_FILE, 'a') as f:
+        f.write('.' if hit else str(size) + '\n')
+
+# Return the number of hits and misses of the object cache
+def getObjcacheStats():
+    try:
+        hits = os.path.getsize(OBJCACHE_HITS_FILE)
+    except OSError:
+        hits = 0
+    try:
+        with open(OBJCACHE_MISSES_FILE) as f:
+            misses = f.read().count('\n')
+    except IOError:
+        misses = 0
+    return { 'hits': hits, 'misses': misses }
+
+# Run a compiler command line ('compiler' followed by its arguments), taking
+# the object from the cache when possible. Only the compilation of a single
+# source to an object is cached, any other command is just run. 'hit' tells
+# if the last object came from the cache.
+# Returns the exit code of the compiler
+def runCachedCompiler(command):
+    runCachedCompiler.hit = False
+    compiler, args = command[0], command[1:]
+    if not '-c' in args or not '-o' in args or args.index('-o') + 1 >= len(args) or \
+       not args[-1].endswith('.c') or not getConfig('objcache'):
+        return subprocess.call(command)
+    source = args[-1]
+    output = args[args.index('-o') + 1]
+    # The flags without the output and the options about dependency files
+    flags = []
+    skip = False
+    for arg in args[:-1]:
+        if skip:
+            skip = False
+        elif arg in ('-o', '-MF', '-MT', '-MQ'):
+            skip = True
+        elif not arg in ('-c', '-MD', '-MMD', '-MP'):
+            flags.append(arg)
+    # The preprocessor writes the dependency file too, which is needed
+    # even if the object comes from the cache
+    preprocessCommand = [compiler] + flags + ['-E', source]
+    if '-MMD' in args or '-MD' in args:
+        depFile = args[args.index('-MF') + 1] if '-MF' in args else os.path.splitext(output)[0] + '.d'
+        preprocessCommand += ['-MMD' if '-MMD' in args else '-MD', '-MF', depFile, '-MT', output]
+        if '-MP' in args:
+            preprocessCommand.append('-MP')
+    preprocessProcess = subprocess.Popen(preprocessCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    preprocessed, errors = preprocessProcess.communicate()
+    if preprocessProcess.returncode != 0:
+        sys.stderr.write(errors)
+        return preprocessProcess.returncode
+
+    keyHash = hashlib.sha256()
+    keyHash.update(getCompilerVersion(compiler) + '\0')
+    keyHash.update('\0'.join(flags) + '\0')
+    keyHash.update(preprocessed)
+    objectPath, logPath = getObjcachePaths(keyHash.hexdigest())
+
+    if os.path.isfile(objectPath):
+        try:
+            shutil.copyfile(objectPath, output)
+            # The modification time tells the least recently used objects
+            os.utime(objectPath, None)
+            if os.path.isfile(logPath):
+                with open(logPath) as f:
+                    sys.stderr.write(f.read())
+            countObjcacheAccess(True)
+            runCachedCompiler.hit = True
+            return 0
+        except (IOError, OSError):
+            pass
+
+    compileProcess = subprocess.Popen(command, stderr=subprocess.PIPE)
+    errors = compileProcess.communicate()[1]
+    sys.stderr.write(errors)
+    if compileProcess.returncode == 0:
+        try:
+            if not os.path.isdir(os.path.dirname(objectPath)):
+                os.makedirs(os.path.dirname(objectPath))
+            tempFilename = objectPath + ".tmp" + str(os.getpid())
+            shutil.copyfile(output, tempFilename)
+            if len(errors) > 0:
+                with open(logPath, 'w') as f:
+                    f.write(errors)
+            os.rename(tempFilename, objectPath)
+            countObjcacheAccess(False, os.path.getsize(objectPath))
+        except (IOError, OSError):
+            pass
+    return compileProcess.returncode
+
+# Return the command line prefix that runs the build commands through the tool
+def getObjcacheWrapper():
+    return ' '.join(pipes.quote(arg) for arg in (sys.executable, os.path.abspath(__file__), 'cc-wrapper'))
+
+# List the cached objects as (modification time, size, paths) tuples
+def listObjcacheEntries():
+    entries = []
+    if not os.path.isdir(OBJCACHE_DIR):
+        return entries
+    for d in os.listdir(OBJCACHE_DIR):
+        if not os.path.isdir(OBJCACHE_DIR + "/" + d): continue
+        for f in os.listdir(OBJCACHE_DIR + "/" + d):
+            if not f.endswith('.o'): continue
+            paths = getObjcachePaths(f[:-2])
+            try:
+                stat = os.stat(paths[0])
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, paths))
+    return entries
+
+# Evict the least recently used objects beyond the 'objcacheSizeLimitMB' limit.
+# The size of the cache is kept in OBJCACHE_SIZE_FILE, along with how much of
+# the misses log it accounts for: the objects added since then are summed to
+# it, and the cache is scanned only when that goes over the limit (or with
+# 'force'). Returns the number of objects evicted
+def enforceObjcacheLimit(force=False):
+    limit = int(getConfig('objcacheSizeLimitMB')) * 1024 * 1024
+    evicted = 0
+    with FileLock(OBJCACHE_DIR + "/.lock"):
+        try:
+            with open(OBJCACHE_SIZE_FILE) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = { 'size': None, 'offset': 0 }
+        try:
+            with open(OBJCACHE_MISSES_FILE) as f:
+                f.seek(state['offset'])
+                added = f.read()
+        except IOError:
+            added = ''
+        # An append may be in progress
+        added = added[:added.rfind('\n') + 1]
+        state['offset'] += len(added)
+        if state['size'] is not None:
+            state['size'] += sum(int(size) for size in added.split())
+        if force or state['size'] is None or state['size'] > limit:
+            entries = sorted(listObjcacheEntries())
+            size = sum(entry[1] for entry in entries)
+            for mtime, entrySize, paths in entries:
+                if size <= limit:
+                    break
+                for path in paths:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                size -= entrySize
+                evicted += 1
+            state['size'] = size
+        if not os.path.isdir(OBJCACHE_DIR):
+            os.makedirs(OBJCACHE_DIR)
+        writeJSONAtomic(OBJCACHE_SIZE_FILE, state)
+    return evicted
+
+def printObjcacheStats():
+    stats = getObjcacheStats()
+    entries = listObjcacheEntries()
+    accesses = stats['hits'] + stats['misses']
+    print CLIFormat.ROWNAME + "[Objects]  " + CLIFormat.ENDF + "{} ({} of {} MB)".format(len(entries), formatSize(sum(e[1] for e in entries)), getConfig('objcacheSizeLimitMB'))
+    print CLIFormat.ROWNAME + "[Hits]     " + CLIFormat.ENDF + "{} ({:.1f}%)".format(stats['hits'], 100.0 * stats['hits'] / accesses if accesses > 0 else 0)
+    print CLIFormat.ROWNAME + "[Misses]   " + CLIFormat.ENDF + str(stats['misses'])
+
+def clearObjcache():
+    with FileLock(OBJCACHE_DIR + "/.lock"):
+        for d in os.listdir(OBJCACHE_DIR):
+            if os.path.isdir(OBJCACHE_DIR + "/" + d):
+                shutil.rmtree(OBJCACHE_DIR + "/" + d)
+        for f in (OBJCACHE_HITS_FILE, OBJCACHE_MISSES_FILE, OBJCACHE_SIZE_FILE):
+            if os.path.isfile(f):
+                os.remove(f)
+
+
+'''
+    Footprint analysis functions
+'''
+# The footprint of a build is read from the ELF file (sections and symbols) and
+# from the map file written by the linker (the input sections of each object).
+# The footprint of each build is saved in SIZE_HISTORY_FILE, to compare the
+# builds and to check the growth against the budgets set in config.mk
+
+# Reader of the sections and symbols of an ELF file
+class ELFFile:
+
+    SHT_SYMTAB = 2
+    SHT_NOBITS = 8
+    SHF_WRITE = 0x1
+    SHF_ALLOC = 0x2
+    STT_OBJECT = 1
+    STT_FUNC = 2
+    SHN_LORESERVE = 0xff00
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            ident = f.read(16)
+            if len(ident) < 16 or ident[:4] != '\x7fELF' or not ident[4] in '\x01\x02':
+                raise ValueError(filename + " is not an ELF file")
+            self.is64 = ident[4] == '\x02'
+            self.endian = '<' if ident[5] == '\x01' else '>'
+            header = struct.unpack(self.endian + ('HHIQQQIHHHHHH' if self.is64 else 'HHIIIIIHHHHHH'),
+                                   f.read(48 if self.is64 else 36))
+            sectionsOffset, sectionSize, sectionsCount, namesIndex = header[5], header[10], header[11], header[12]
+            self.sections = []
+            for i in range(sectionsCount):
+                f.seek(sectionsOffset + i * sectionSize)
+                fields = struct.unpack(self.endian + ('IIQQQQIIQQ' if self.is64 else 'IIIIIIIIII'),
+                                       f.read(64 if self.is64 else 40))
+                self.sections.append({ 'nameOffset': fields[0], 'type': fields[1], 'flags': fields[2],
+                                       'addr': fields[3], 'offset': fields[4], 'size': fields[5],
+                                       'link': fields[6] })
+            names = self.readSection(f, self.sections[namesIndex]) if namesIndex < len(self.sections) else ''
+            for section in self.sections:
+                section['name'] = names[section['nameOffset']:names.find('\0', section['nameOffset'])]
+
+    def readSection(self, f, section):
+        if section['type'] == ELFFile.SHT_NOBITS:
+            return ''
+        f.seek(section['offset'])
+        return f.read(section['size'])
+
+    # Return the memories ('flash', 'ram' or both) a section takes space in
+    @staticmethod
+    def getSectionMemories(section):
+        if not section['flags'] & ELFFile.SHF_ALLOC:
+            return ()
+        if section['type'] == ELFFile.SHT_NOBITS:
+            return ('ram',)
+        if section['flags'] & ELFFile.SHF_WRITE:
+            return ('flash', 'ram')
+        return ('flash',)
+
+    # Return the functions and variables as (name, size, section name) tuples
+    def getSymbols(self):
+        symbols = []
+        with open(self.filename, 'rb') as f:
+            for table in self.sections:
+                if table['type'] != ELFFile.SHT_SYMTAB:
+                    continue
+                names = self.readSection(f, self.sections[table['link']])
+                data = self.readSection(f, table)
+                entrySize = 24 if self.is64 else 16
+                for offset in range(0, len(data) - entrySize + 1, entrySize):
+                    if self.is64:
+                        nameOffset, info, other, index, value, size = struct.unpack_from(self.endian + 'IBBHQQ', data, offset)
+                    else:
+                        nameOffset, value, size, info, other, index = struct.unpack_from(self.endian + 'IIIBBH', data, offset)
+                    if size == 0 or not info & 0xf in (ELFFile.STT_OBJECT, ELFFile.STT_FUNC) or \
+                       index == 0 or index >= ELFFile.SHN_LORESERVE or index >= len(self.sections):
+                        continue
+                    name = names[nameOffset:names.find('\0', nameOffset)]
+                    symbols.append((name, size, self.sections[index]['name']))
+        return symbols
+
+# Read the map file written by the linker line by line, yielding the input
+# sections placed in the output ones as (output section, object, size) tuples.
+# The archive members are named like 'libhal.a(stm32f4xx_hal.o)'
+def parseMapFile(filename):
+    started = False
+    outputSection = None
+    pendingName = None
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not started:
+                started = line.startswith("Linker script and memory map")
+                continue
+            if line.startswith(('OUTPUT(', 'LOAD ')) or len(line.strip()) == 0:
+                continue
+            if pendingName is not None:
+                # The name of a section too long was on the previous line
+                line = pendingName + " " + line.strip()
+                pendingName = None
+            if not line.startswith(' '):
+                fields = line.split()
+                if len(fields) == 1:
+                    pendingName = fields[0]
+                outputSection = fields[0]
+                continue
+            fields = line.split()
+            if fields[0] == '*fill*':
+                if len(fields) >= 3 and outputSection is not None:
+                    yield (outputSection, '*fill*', int(fields[2], 16))
+                continue
+            if not (fields[0].startswith('.') or fields[0] == 'COMMON'):
+                continue
+            if len(fields) == 1:
+                pendingName = ' ' + fields[0]
+            elif len(fields) >= 4 and fields[1].startswith('0x') and fields[2].startswith('0x') and outputSection is not None:
+                size = int(fields[2], 16)
+                if size > 0:
+                    yield (outputSection, os.path.normpath(' '.join(fields[3:])), size)
+
+# Return the footprint of the last build of a project: the flash and RAM used,
+# the size of each section, and the flash and RAM used by each object and symbol
+def getBuildFootprint(projectDir):
+    name = os.path.basename(os.path.abspath(projectDir))
+    elf = ELFFile(projectDir + "/build/" + name + ".elf")
+    memories = dict((section['name'], ELFFile.getSectionMemories(section)) for section in elf.sections)
+    footprint = { 'time': time.time(), 'elfTime': os.path.getmtime(elf.filename),
+                  'flash': 0, 'ram': 0, 'sections': { }, 'objects': { }, 'symbols': { } }
+    for section in elf.sections:
+        for memory in memories[section['name']]:
+            footprint[memory] += section['size']
+        if len(memories[section['name']]) > 0:
+            footprint['sections'][section['name']] = section['size']
+    for symbolName, size, sectionName in elf.getSymbols():
+        entry = footprint['symbols'].setdefault(symbolName, [0, 0])
+        for memory in memories.get(sectionName, ()):
+            entry[0 if memory == 'flash' else 1] += size
+    mapFilename = projectDir + "/build/" + name + ".map"
+    if os.path.isfile(mapFilename):
+        for sectionName, objectName, size in parseMapFile(mapFilename):
+            if len(memories.get(sectionName, ())) == 0:
+                continue
+            # With LTO the code is in temporary objects (like
+            # /tmp/ccXXXXXX.ltrans0.ltrans.o), named differently by each build
+            if re.search(r'\.ltrans[^/]*\.o$', objectName):
+                objectName = SIZE_LTO_OBJECTS
+            entry = footprint['objects'].setdefault(objectName, [0, 0])
+            for memory in memories[sectionName]:
+                entry[0 if memory == 'flash' else 1] += size
+    return footprint
+
+def loadSizeHistory(projectDir):
+    try:
+        with open(projectDir + "/" + SIZE_HISTORY_FILE) as f:
+            return json.load(f)
+    except:
+        return []
+
+# Add the footprint of the last build to the size history of the project,
+# unless the ELF file didn't change. Returns the history
+def recordSizeHistory(projectDir):
+    history = loadSizeHistory(projectDir)
+    try:
+        footprint = getBuildFootprint(projectDir)
+    except (IOError, OSError, ValueError, struct.error):
+        return history
+    if len(history) > 0 and history[-1]['elfTime'] == footprint['elfTime']:
+        return history
+    history = (history + [footprint])[-SIZE_HISTORY_ENTRIES:]
+    if not os.path.isdir(projectDir + "/" + PROJECT_TOOL_DIR):
+        os.makedirs(projectDir + "/" + PROJECT_TOOL_DIR)
+    writeJSONAtomic(projectDir + "/" + SIZE_HISTORY_FILE, history)
+    return history
+
+# Parse a size from config.mk, in bytes or with a k or M suffix
+def parseSizeValue(value):
+    match = re.match(r'^(\d+)\s*([kKmM]?)$', value.strip())
+    if match is None:
+        return None
+    return int(match.group(1)) * { '': 1, 'k': 1024, 'm': 1024 * 1024 }[match.group(2).lower()]
+
+# Check the last build against the budgets of the project config.mk: the
+# FLASH_BUDGET and RAM_BUDGET limits, and the FLASH_GROWTH_LIMIT and
+# RAM_GROWTH_LIMIT the use can grow by since the previous build.
+# Returns the list of the budgets exceeded
+def checkSizeBudget(projectDir, history):
+    try:
+        config = loadMakeVariables(projectDir + "/config.mk")
+    except IOError:
+        return []
+    if len(history) == 0:
+        return []
+    errors = []
+    current = history[-1]
+    for memory in ('flash', 'ram'):
+        budget = parseSizeValue(config.get(memory.upper() + '_BUDGET', ''))
+        if budget is not None and current[memory] > budget:
+            errors.append("{} use of {} exceeds the budget of {}".format(
+                          memory.upper(), formatSize(current[memory]), formatSize(budget)))
+        limit = parseSizeValue(config.get(memory.upper() + '_GROWTH_LIMIT', ''))
+        if limit is not None and len(history) > 1 and current[memory] - history[-2][memory] > limit:
+            errors.append("{} use grew by {}, more than the limit of {}".format(
+                          memory.upper(), formatSize(current[memory] - history[-2][memory]), formatSize(limit)))
+    return errors
+
+# Print the biggest entries of a footprint table ({ name: [flash, RAM] })
+def printFootprintTable(title, table, entries):
+    print "\n" + title + ":"
+    print "{:>10} {:>10}".format("FLASH", "RAM")
+    for name, usage in sorted(table.items(), key=lambda item: -(item[1][0] + item[1][1]))[:entries]:
+        print "{:>10} {:>10}    {}".format(usage[0], usage[1], name)
+
+# Print the differences of a footprint table between two builds
+def printFootprintDiff(title, previous, current, entries):
+    changes = []
+    for name in set(previous) | set(current):
+        before = previous.get(name, [0, 0])
+        after = current.get(name, [0, 0])
+        if before != after:
+            changes.append((name, after[0] - before[0], after[1] - before[1],
+                            "added" if not name in previous else "removed" if not name in current else ""))
+    if len(changes) == 0:
+        return
+    print "\n" + title + ":"
+    print "{:>10} {:>10}".format("FLASH", "RAM")
+    for name, flash, ram, note in sorted(changes, key=lambda change: -(abs(change[1]) + abs(change[2])))[:entries]:
+        print "{:>+10} {:>+10}    {} {}".format(flash, ram, name, note).rstrip()
+
+# Print the footprint of the last build of a project, by section, object and
+# symbol, and the differences from the previous build
+def printSizeReport(projectDir):
+    history = recordSizeHistory(projectDir)
+    if len(history) == 0:
+        ERROR("The project has not been built yet")
+    current = history[-1]
+    print CLIFormat.ROWNAME + "[FLASH]    " + CLIFormat.ENDF + "{} bytes".format(current['flash'])
+    print CLIFormat.ROWNAME + "[RAM]      " + CLIFormat.ENDF + "{} bytes".format(current['ram'])
+    print "\nSections:"
+    for name, size in sorted(current['sections'].items(), key=lambda item: -item[1]):
+        print "{:>10}    {}".format(size, name)
+    printFootprintTable("Objects", current['objects'], SIZE_REPORT_ENTRIES)
+    if SIZE_LTO_OBJECTS in current['objects']:
+        print "(the code optimized at link time can't be told apart by object, see the symbols)"
+    printFootprintTable("Symbols", current['symbols'], SIZE_REPORT_ENTRIES)
+    if len(history) < 2:
+        print "\nNo previous build to compare with"
+        return
+    previous = history[-2]
+    print "\nSince the previous build ({}): FLASH {:+d} bytes, RAM {:+d} bytes".format(
+          time.strftime("%Y-%m-%d %H:%M", time.localtime(previous['time'])),
+          current['flash'] - previous['flash'], current['ram'] - previous['ram'])
+    printFootprintDiff("Objects changed", previous['objects'], current['objects'], SIZE_REPORT_ENTRIES)
+    printFootprintDiff("Symbols changed", previous['symbols'], current['symbols'], SIZE_REPORT_ENTRIES)
+
+
+'''
+    SUBPROGRAM: Project compilation script
+'''
+# Extract the section sizes from the output of 'size' (berkeley format), among
+# the last lines of the build output
+def parseMakeOutput(lines):
+    lines = list(lines)[-4:]
+    sizeLine = None
+    for i in range(len(lines) - 1):
+        line = lines[i]
+        if 'bss' in line and 'data' in line:
+            sizeLine = lines[i + 1]
+    if sizeLine is None:
+        return None
+    tokens = sizeLine.split()
+    result = {  'text': int(tokens[0]),
+                'data': int(tokens[1]),
+                'bss':  int(tokens[2]) }
+    return result
+
+# Return the number of files 'make' is going to compile, without the cost of a
+# dry run: the sources whose object is missing, or older than the flags file
+# or than any file listed in its dependency file. The HAL sources are the ones
+# listed in HAL_SOURCES_MK, or none with the HAL library. A change of the flags
+# is only seen by 'make' itself, so the count can be short of that
+def countOutdatedObjects(projectDir, halLib=False, variables=None):
+    build = (variables or { }).get('BUILD', 'build')
+    try:
+        dirs = loadMakeVariables(projectDir + "/dirs.mk").get('DIRS', '').split()
+        halSources = None
+        if not halLib and os.path.isfile(projectDir + "/" + HAL_SOURCES_MK):
+            halSources = loadMakeVariables(projectDir + "/" + HAL_SOURCES_MK).get('HAL_SOURCES', '').split()
+    except IOError:
+        return 0
+    sources = []
+    for d in dirs:
+        if d == "system/hal" and (halLib or halSources is not None):
+            continue
+        sources += [os.path.relpath(f, projectDir) for f in glob.glob(projectDir + "/" + d + "/*.c")]
+    sources += halSources or []
+
+    mtimes = { }
+    def getMtime(filename):
+        if not filename in mtimes:
+            try:
+                mtimes[filename] = os.path.getmtime(os.path.join(projectDir, filename))
+            except OSError:
+                mtimes[filename] = None
+        return mtimes[filename]
+
+    flagsTime = getMtime(build + "/flags.txt")
+    count = 0
+    for source in sources:
+        objTime = getMtime(build + "/obj/" + source[:-2] + ".o")
+        try:
+            with open(projectDir + "/" + build + "/obj/" + source[:-2] + ".d") as f:
+                # The first rule is the object, the others (-MP) the headers
+                deps = f.read().replace('\\\n', ' ').split('\n')[0].split(':', 1)[-1].split()
+        except IOError:
+            deps = None
+        if objTime is None or deps is None or (flagsTime is not None and flagsTime > objTime):
+            count += 1
+        elif any(getMtime(dep) is None or getMtime(dep) > objTime for dep in [source] + deps):
+            count += 1
+    return count
+
+# Build the project. The output of 'make' is read while it runs: with
+# 'verbose', a "[n/N] Compiling X" progress line is printed for each file
+# and the diagnostics are printed as they arrive. Only the last lines are
+# kept, to read the memory usage or to report the errors. The prebuilt HAL
+# library matching the project is linked when available (or built first, with
+# 'buildHALlib'), otherwise the HAL sources used are compiled.
+# The jobs of 'make' are limited by 'jobserver' (a MakeJobserver) if given.
+# With 'profile', the timing of each build step is appended to that file (see
+# runToolWrapper()), along with the '-ftime-report' data with 'timeReport'.
+# The make 'variables' (like BUILD or OPTIMIZE) override the project ones for
+# a build that isn't the main one, so it's not checked against the budgets.
+# With 'usage' (a dictionary), the CPU time taken by 'make' and the commands
+# it ran is stored in its 'cpu' key.
+# Returns (True, last lines, flash usage, RAM usage) or (False, last lines)
+def compileProject(projectDir, verbose=False, buildHALlib=False, jobserver=None, profile=None, timeReport=False, variables=None, usage=None):
+    command = ['make'] if jobserver is not None else ['make', '-j' + str(getCPUcount() + 1)]
+    command += [name + '=' + value for name, value in sorted((variables or { }).items())]
+    env = jobserver.getEnvironment() if jobserver is not None else None
+    if profile is not None:
+        env = dict(env or os.environ)
+        env['STM32TOOL_PROFILE'] = os.path.abspath(profile)
+        env['STM32TOOL_TIME_REPORT'] = '1' if timeReport else ''
+    if getConfig('objcache') or profile is not None:
+        command.append('TOOLWRAPPER=' + getObjcacheWrapper())
+    if profile is not None:
+        command.append('PROFILEWRAPPER=' + getObjcacheWrapper())
+    halSources = writeHALsourcesList(projectDir)
+    halCommand = command + (['HAL_SOURCES_MK=' + HAL_SOURCES_MK] if halSources is not None else [])
+    halLib = getHALlibraryPath(projectDir, variables, halSources)
+    if halLib is not None and not os.path.isfile(halLib):
+        if not buildHALlib or not buildHALlibrary(projectDir, halLib, halCommand, env):
+            halLib = None
+    command = command + ['HAL_LIB=' + halLib] if halLib is not None else halCommand
+    total = countOutdatedObjects(projectDir, halLib is not None, variables) if verbose else 0
+    makeProcess = subprocess.Popen(command, stderr=subprocess.STDOUT, stdout=subprocess.PIPE, cwd=projectDir, bufsize=-1, env=env)
+    lastLines = collections.deque(maxlen=MAKE_OUTPUT_TAIL_LINES)
+    compiled = 0
+    sizeLines = 0
+    for line in iter(makeProcess.stdout.readline, ''):
+        line = line.rstrip('\n')
+        lastLines.append(line)
+        if not verbose:
+            continue
+        if line.startswith("Compiling "):
+            compiled += 1
+            print "[{}/{}] {}".format(compiled, max(compiled, total), line)
+        elif 'bss' in line and 'data' in line:
+            # The output of 'size' is reported by printMemoryUsage()
+            sizeLines = 2
+        elif sizeLines == 0:
+            print line
+        sizeLines = max(0, sizeLines - 1)
+        sys.stdout.flush()
+    if usage is not None:
+        # Unlike the wall time, the CPU time of a build doesn't depend on
+        # what else is running
+        status, resources = os.wait4(makeProcess.pid, 0)[1:]
+        returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        usage['cpu'] = resources.ru_utime + resources.ru_stime
+    else:
+        returncode = makeProcess.wait()
+    if getConfig('objcache'):
+        enforceObjcacheLimit()
+    if returncode != 0:
+        return (False, "\n".join(lastLines))
+    budgetErrors = checkSizeBudget(projectDir, recordSizeHistory(projectDir)) if variables is None else []
+    if len(budgetErrors) > 0:
+        if verbose:
+            print "\n".join(budgetErrors)
+        return (False, "\n".join(list(lastLines) + budgetErrors))
     else:
-        sizeInfo = parseMakeOutput(out)
+        sizeInfo = parseMakeOutput(lastLines)
         flashUsage = sizeInfo['text'] + sizeInfo['data']
         ramUsage = sizeInfo['data'] + sizeInfo['bss']
-        return (True, err, flashUsage, ramUsage)
+        return (True, "\n".join(lastLines), flashUsage, ramUsage)
+
+# Print how much of the MCU flash and RAM is used, given in bytes
+def printMemoryUsage(mcu, flashUsage, ramUsage):
+    flashUsed = float(flashUsage) / 1024
+    flashPercent = flashUsed / float(mcu.flash) * 100
+    ramUsed = float(ramUsage) / 1024
+    ramPercent = ramUsed / float(mcu.ram) * 100
+    print CLIFormat.ROWNAME + "[FLASH]    " + CLIFormat.ENDF + "{:.1f}/{} kB\t({:.1f}%)".format(flashUsed, mcu.flash, flashPercent)
+    print CLIFormat.ROWNAME + "[RAM]      " + CLIFormat.ENDF + "{:.1f}/{} kB\t({:.1f}%)".format(ramUsed, mcu.ram, ramPercent)
 
 def cleanProject(projectDir):
     FNULL = open(os.devnull, 'w')
     subprocess.Popen(['make', 'clean'], stdout=FNULL, stderr=subprocess.STDOUT, cwd=projectDir).wait()
 
 
+'''
+    SUBPROGRAM: Build profiling
+'''
+# While a build is profiled, the commands run by the Makefile through
+# TOOLWRAPPER append their timings to the file in STM32TOOL_PROFILE, one JSON
+# object per line, and profileProject() builds the report from them
+
+# Return the kind of a build command ('compile', 'link', 'objcopy', 'size' or
+# 'other') and the file it produces or reads
+def getBuildStepInfo(command):
+    tool, args = os.path.basename(command[0]), command[1:]
+    target = args[args.index('-o') + 1] if '-o' in args and args.index('-o') + 1 < len(args) else args[-1] if args else ''
+    if tool.endswith('gcc'):
+        if '-c' in args:
+            return ('compile', args[-1])
+        return ('link', target)
+    for kind in ('objcopy', 'size'):
+        if tool.endswith(kind):
+            return (kind, target)
+    return ('other', target)
+
+# Parse the output of '-ftime-report', returning the wall time of each timer
+def parseTimeReport(output):
+    timers = { }
+    for line in output.splitlines():
+        match = re.match(r'^\s*(.+?)\s*:\s*[\d.]+\s*\(\s*\d+%\)\s*[\d.]+\s*\(\s*\d+%\)\s*([\d.]+)', line)
+        if match is not None:
+            timers[match.group(1)] = float(match.group(2))
+    return timers
+
+# Run a command of the project Makefile (TOOLWRAPPER): the compilations go
+# through the object cache, and the timings are recorded while profiling.
+# Returns the exit code of the command
+def runToolWrapper(command):
+    profileFilename = os.environ.get('STM32TOOL_PROFILE')
+    if not profileFilename:
+        return runCachedCompiler(command)
+    kind, target = getBuildStepInfo(command)
+    step = { 'kind': kind, 'target': target, 'start': time.time(), 'cached': False }
+    startTimes = os.times()
+    if kind == 'compile' and os.environ.get('STM32TOOL_TIME_REPORT'):
+        # The report is only produced by an actual compilation, not from the cache
+        compileProcess = subprocess.Popen(command[:-1] + ['-ftime-report', command[-1]], stderr=subprocess.PIPE)
+        errors = compileProcess.communicate()[1]
+        step['timeReport'] = parseTimeReport(errors)
+        sys.stderr.write("".join(line for line in errors.splitlines(True)
+                                    if not re.match(r'^\s*(.+?)\s*:\s*[\d.]+\s*\(', line) and
+                                    not line.lstrip().startswith(('Time variable', 'TOTAL'))))
+        result = compileProcess.returncode
+    else:
+        result = runCachedCompiler(command)
+        step['cached'] = runCachedCompiler.hit
+    endTimes = os.times()
+    step['wall'] = time.time() - step['start']
+    step['cpu'] = (endTimes[2] - startTimes[2]) + (endTimes[3] - startTimes[3])
+    with open(profileFilename, 'a') as f:
+        f.write(json.dumps(step) + "\n")
+    return result
+
+# Count how many translation units include each header, from the dependency
+# files written by the compiler in the build directory
+def countIncludedHeaders(projectDir):
+    counts = collections.Counter()
+    for root, dirs, files in os.walk(projectDir + "/build/obj"):
+        for f in files:
+            if not f.endswith('.d'): continue
+            with open(root + "/" + f) as fh:
+                # The first rule is the object, the others (-MP) the headers
+                rule = fh.read().replace('\\\n', ' ').split('\n')[0]
+            counts.update(set(dep for dep in rule.split(':', 1)[-1].split() if dep.endswith('.h')))
+    return counts
+
+# Write the Chrome trace (chrome://tracing or ui.perfetto.dev) of the steps of
+# a build, each on the first row that is free at its start
+def writeChromeTrace(filename, steps):
+    origin = min(step['start'] for step in steps) if steps else 0
+    rowsEnd = []
+    events = []
+    for step in sorted(steps, key=lambda step: step['start']):
+        row = next((i for i, end in enumerate(rowsEnd) if end <= step['start']), len(rowsEnd))
+        if row == len(rowsEnd):
+            rowsEnd.append(0)
+        rowsEnd[row] = step['start'] + step['wall']
+        events.append({ 'name': step['target'], 'cat': step['kind'], 'ph': 'X', 'pid': 1, 'tid': row,
+                        'ts': int((step['start'] - origin) * 1e6), 'dur': int(step['wall'] * 1e6),
+                        'args': { 'cpu': step['cpu'], 'cached': step['cached'] } })
+    with open(filename, 'w') as f:
+        json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, f)
+
+# Build a project recording the timings of each step, then print a report and
+# write it to PROFILE_FILE, along with a Chrome trace in PROFILE_TRACE_FILE.
+# With 'timeReport' the compilations also collect the '-ftime-report' data.
+# Returns the same as compileProject()
+def profileProject(projectDir, timeReport=False):
+    logFilename = projectDir + "/" + PROFILE_LOG_FILE
+    if not os.path.isdir(os.path.dirname(logFilename)):
+        os.makedirs(os.path.dirname(logFilename))
+    if os.path.isfile(logFilename):
+        os.remove(logFilename)
+    startTime = time.time()
+    result = compileProject(projectDir, verbose=True, profile=logFilename, timeReport=timeReport)
+    totalTime = time.time() - startTime
+    steps = []
+    if os.path.isfile(logFilename):
+        with open(logFilename) as f:
+            steps = [json.loads(line) for line in f if line.strip()]
+    headers = countIncludedHeaders(projectDir)
+    kinds = collections.OrderedDict()
+    for step in sorted(steps, key=lambda step: step['start']):
+        summary = kinds.setdefault(step['kind'], { 'steps': 0, 'cached': 0, 'wall': 0.0, 'cpu': 0.0 })
+        summary['steps'] += 1
+        summary['cached'] += 1 if step['cached'] else 0
+        summary['wall'] += step['wall']
+        summary['cpu'] += step['cpu']
+    timers = collections.Counter()
+    for step in steps:
+        timers.update(step.get('timeReport', { }))
+    slowest = sorted(steps, key=lambda step: step['wall'], reverse=True)[:PROFILE_REPORT_ENTRIES]
+    writeJSONAtomic(projectDir + "/" + PROFILE_FILE, {
+        'wall': totalTime, 'steps': steps, 'summary': kinds,
+        'headers': headers.most_common(), 'timers': timers.most_common() })
+    writeChromeTrace(projectDir + "/" + PROFILE_TRACE_FILE, steps)
+
+    print "\nBuild profile ({:.2f} s):".format(totalTime)
+    for kind, summary in kinds.items():
+        print CLIFormat.ROWNAME + "[{}]".format(kind).ljust(11) + CLIFormat.ENDF + "{} steps ({} from the object cache), {:.2f} s wall, {:.2f} s CPU".format(
+              summary['steps'], summary['cached'], summary['wall'], summary['cpu'])
+    if len(slowest) > 0:
+        print "\nSlowest steps:"
+        for step in slowest:
+            print "{:>8.2f} s  {:<8} {}".format(step['wall'], step['kind'], step['target'])
+    if len(headers) > 0:
+        print "\nMost included headers:"
+        for header, count in headers.most_common(PROFILE_REPORT_ENTRIES):
+            print "{:>8}    {}".format(count, header)
+    if len(timers) > 0:
+        print "\nCompiler time (-ftime-report):"
+        for timer, seconds in timers.most_common(PROFILE_REPORT_ENTRIES):
+            print "{:>8.2f} s  {}".format(seconds, timer)
+    print "\nProfile written to {}, trace to {}".format(PROFILE_FILE, PROFILE_TRACE_FILE)
+    return result
+
+
+'''
+    SUBPROGRAM: Batch projects build
+'''
+# Return the version of GNU make as a (major, minor) tuple
+def getMakeVersion():
+    versionProcess = subprocess.Popen(['make', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    match = re.search(r'(\d+)\.(\d+)', versionProcess.communicate()[0])
+    return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+
+# A GNU make jobserver shared by the 'make' processes of many projects, so that
+# together they don't run more than 'jobs' jobs: a pipe holding a token for
+# each job slot, besides the one every 'make' process has of its own
+class MakeJobserver:
+
+    def __init__(self, jobs, makes):
+        self.readFd, self.writeFd = os.pipe()
+        os.write(self.writeFd, '+' * max(0, jobs - makes))
+        option = '--jobserver-auth' if getMakeVersion() >= (4, 2) else '--jobserver-fds'
+        self.makeflags = ' -j {}={},{}'.format(option, self.readFd, self.writeFd)
+
+    def getEnvironment(self):
+        env = dict(os.environ)
+        env['MAKEFLAGS'] = self.makeflags
+        return env
+
+    def close(self):
+        os.close(self.readFd)
+        os.close(self.writeFd)
+
+# Build many projects at once, sharing the CPUs through a MakeJobserver, and
+# print a summary of the results. With 'failFast' no other project is started
+# after a failure. Returns True if all the projects have been built
+def buildProjects(projectDirs, rebuild=False, failFast=False):
+    jobs = getCPUcount() + 1
+    makes = min(len(projectDirs), jobs)
+    jobserver = MakeJobserver(jobs, makes)
+    failed = threading.Event()
+
+    def buildProject(projectDir):
+        if failFast and failed.is_set():
+            return (projectDir, None, 0)
+        startTime = time.time()
+        if rebuild:
+            cleanProject(projectDir)
+        result = compileProject(projectDir, jobserver=jobserver)
+        if result[0] == False:
+            failed.set()
+        return (projectDir, result, time.time() - startTime)
+
+    print "Building {} projects with {} jobs...".format(len(projectDirs), jobs)
+    results = { }
+    buildPool = multiprocessing.pool.ThreadPool(makes)
+    for projectDir, result, duration in buildPool.imap_unordered(buildProject, projectDirs):
+        results[projectDir] = (result, duration)
+        if result is None:
+            continue
+        elif result[0] == False:
+            print CLIFormat.ERROR + "[FAILED] " + projectDir + CLIFormat.ENDF
+            print result[1]
+        else:
+            print "Built " + projectDir
+        sys.stdout.flush()
+    buildPool.close()
+    buildPool.join()
+    jobserver.close()
+
+    print "\nSummary:"
+    width = max(len(projectDir) for projectDir in projectDirs) + 4
+    for projectDir in projectDirs:
+        result, duration = results[projectDir]
+        if result is None:
+            details = "skipped"
+        elif result[0] == False:
+            details = CLIFormat.ERROR + "failed" + CLIFormat.ENDF + "    {:>6.1f} s".format(duration)
+        else:
+            mcu = MCU()
+            mcu.loadFromJSON(projectDir + "/mcu.json")
+            details = "ok        {:>6.1f} s    FLASH {:.1f}/{} kB ({:.1f}%)    RAM {:.1f}/{} kB ({:.1f}%)".format(
+                      duration, result[2] / 1024.0, mcu.flash, result[2] / 10.24 / mcu.flash,
+                      result[3] / 1024.0, mcu.ram, result[3] / 10.24 / mcu.ram)
+        print CLIFormat.ROWNAME + projectDir.ljust(width) + CLIFormat.ENDF + details
+    return all(result is not None and result[0] for result, duration in results.values())
+
+
+'''
+    SUBPROGRAM: Optimization sweep
+'''
+# Build a project with each optimization level in SWEEP_OPTIMIZATIONS, with and
+# without LTO, each in its own directory under SWEEP_DIR. The builds run at the
+# same time sharing a MakeJobserver, then the configurations are printed from
+# the smallest one with the CPU time of their build, and the ones that don't
+# fit the MCU are marked
+def sweepProject(projectDir):
+    mcu = MCU()
+    mcu.loadFromJSON(projectDir + "/mcu.json")
+    configurations = collections.OrderedDict()
+    for optimize in SWEEP_OPTIMIZATIONS:
+        for lto in ('-flto', ''):
+            name = optimize.lstrip('-') + ('-lto' if lto else '')
+            configurations[name] = { 'OPTIMIZE': optimize, 'LTO': lto, 'BUILD': SWEEP_DIR + "/" + name }
+    # Every configuration is built from scratch, so that the CPU times compare
+    # full builds and not what was left by a previous sweep
+    shutil.rmtree(projectDir + "/" + SWEEP_DIR, ignore_errors=True)
+    writeHALsourcesList(projectDir)
+    jobs = getCPUcount() + 1
+    makes = min(len(configurations), jobs)
+    jobserver = MakeJobserver(jobs, makes)
+
+    # The builds run at the same time, so their wall times can't be compared
+    def buildConfiguration(name):
+        usage = { }
+        result = compileProject(projectDir, jobserver=jobserver, variables=configurations[name], usage=usage)
+        return (name, result, usage.get('cpu', 0))
+
+    print "Building {} configurations with {} jobs...".format(len(configurations), jobs)
+    results = { }
+    buildPool = multiprocessing.pool.ThreadPool(makes)
+    for name, result, duration in buildPool.imap_unordered(buildConfiguration, configurations.keys()):
+        results[name] = (result, duration)
+        print ("Built " if result[0] else "Failed ") + name
+        sys.stdout.flush()
+    buildPool.close()
+    buildPool.join()
+    jobserver.close()
+
+    def fits(result):
+        return result[0] and result[2] <= mcu.flash * 1024 and result[3] <= mcu.ram * 1024
+    ranking = sorted(configurations, key=lambda name: (not fits(results[name][0]), not results[name][0][0],
+                                                       results[name][0][2:] if results[name][0][0] else None))
+    print "\n{:<6}{:<12}{:>22}{:>22}{:>10}".format("Rank", "Config", "FLASH", "RAM", "CPU time")
+    for rank, name in enumerate(ranking):
+        result, duration = results[name]
+        if not result[0]:
+            print "{:<6}".format(rank + 1) + CLIFormat.ROWNAME + "{:<12}".format(name) + CLIFormat.ENDF + CLIFormat.ERROR + "build failed" + CLIFormat.ENDF
+            continue
+        print "{:<6}".format(rank + 1) + CLIFormat.ROWNAME + "{:<12}".format(name) + CLIFormat.ENDF + "{:>22}{:>22}{:>8.1f} s{}".format(
+              "{:.1f} kB ({:.1f}%)".format(result[2] / 1024.0, result[2] / 10.24 / mcu.flash),
+              "{:.1f} kB ({:.1f}%)".format(result[3] / 1024.0, result[3] / 10.24 / mcu.ram),
+              duration, "" if fits(result) else "  doesn't fit " + mcu.name)
+    if fits(results[ranking[0]][0]):
+        configuration = configurations[ranking[0]]
+        print "\nThe smallest build is {}: set 'OPTIMIZE = {}'{} in config.mk to use it".format(
+              ranking[0], configuration['OPTIMIZE'], "" if configuration['LTO'] else " and 'LTO =' (no LTO)")
+    else:
+        WARNING("No configuration fits " + mcu.name)
+
+
 '''
     SUBPROGRAM: Project flashing script
 '''
@@ -551,21 +3359,164 @@ def flashProject_bootloader(projectDir):
     subprocess.Popen(['make', 'program-btl'], cwd=projectDir).wait()
 
 
+'''
+    SUBPROGRAM: Project watching script
+'''
+# Watch a set of directories for changed files with the Linux inotify API.
+# wait() returns the paths written, moved or deleted, or an empty list if
+# nothing changed within the timeout (None to wait forever)
+class InotifyWatcher:
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.dirs = { }
+
+    def setDirs(self, dirs):
+        for wd in self.dirs.keys():
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.dirs = { }
+        for d in dirs:
+            mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_ONLYDIR
+            wd = self.libc.inotify_add_watch(self.fd, d, mask)
+            if wd >= 0:
+                self.dirs[wd] = d
+
+    def wait(self, timeout=None):
+        if len(select.select([self.fd], [], [], timeout)[0]) == 0:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip('\0')
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                # Some events were lost, consider everything changed
+                paths += self.dirs.values()
+            elif wd in self.dirs and len(name) > 0:
+                paths.append(os.path.join(self.dirs[wd], name))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+# Same as InotifyWatcher, comparing the modification times of the files in the
+# directories every WATCH_POLL_INTERVAL seconds
+class PollingWatcher:
+
+    def __init__(self):
+        self.dirs = []
+        self.snapshot = { }
+
+    def scan(self):
+        snapshot = { }
+        for d in self.dirs:
+            if not os.path.isdir(d): continue
+            for f in os.listdir(d):
+                path = os.path.join(d, f)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def setDirs(self, dirs):
+        self.dirs = list(dirs)
+        self.snapshot = self.scan()
+
+    def wait(self, timeout=None):
+        start = time.time()
+        while True:
+            snapshot = self.scan()
+            paths = [path for path in set(snapshot) | set(self.snapshot)
+                     if snapshot.get(path) != self.snapshot.get(path)]
+            self.snapshot = snapshot
+            if len(paths) > 0:
+                return paths
+            if timeout is not None and time.time() - start >= timeout:
+                return []
+            time.sleep(WATCH_POLL_INTERVAL if timeout is None else min(WATCH_POLL_INTERVAL, timeout))
+
+    def close(self):
+        pass
+
+# Return the directories of a project watched for changes: the ones listed in
+# dirs.mk, the linker scripts and the project directory for its Makefiles
+def getWatchedDirs(projectDir):
+    dirs = loadMakeVariables(projectDir + "/dirs.mk").get('DIRS', '').split()
+    dirs = [projectDir] + [os.path.join(projectDir, d) for d in dirs + ['ldscripts']]
+    return [d for d in dirs if os.path.isdir(d)]
+
+# Tell if a changed file can affect the build, to ignore the temporary files
+# of the editors
+def isWatchedFile(path):
+    name = os.path.basename(path)
+    return not name.startswith('.') and (name == 'Makefile' or os.path.splitext(name)[1] in WATCH_EXTENSIONS)
+
+# Build the project every time one of its files changes, until interrupted.
+# The changes are collected until none comes for WATCH_DEBOUNCE seconds, so
+# that saving many files triggers a single build. With 'flash', the project is
+# flashed after each successful build
+def watchProject(projectDir, flash=False):
+    mcu = MCU()
+    mcu.loadFromJSON(projectDir + "/mcu.json")
+    try:
+        watcher = InotifyWatcher()
+    except (OSError, AttributeError, TypeError):
+        WARNING("inotify isn't available, polling the project files for changes")
+        watcher = PollingWatcher()
+    watcher.setDirs(getWatchedDirs(projectDir))
+    changed = None
+    try:
+        while True:
+            startTime = time.time()
+            INFO("Building project" if changed is None else "Changed " + ", ".join(
+                 sorted(os.path.relpath(path, projectDir) for path in changed)))
+            result = compileProject(projectDir, verbose=True)
+            if result[0] == False:
+                print CLIFormat.ERROR + "[ERROR] Errors during project compilation" + CLIFormat.ENDF
+            else:
+                print "\nCompilation successful in {:.2f} s, memory usage:".format(time.time() - startTime)
+                printMemoryUsage(mcu, result[2], result[3])
+                if flash:
+                    flashProject(projectDir)
+            print "\nWatching for changes, press Ctrl+C to stop"
+            sys.stdout.flush()
+            changed = set()
+            while len(changed) == 0:
+                changed.update(path for path in watcher.wait() if isWatchedFile(path))
+            while True:
+                paths = watcher.wait(WATCH_DEBOUNCE)
+                if len(paths) == 0:
+                    break
+                changed.update(path for path in paths if isWatchedFile(path))
+            if os.path.join(projectDir, "dirs.mk") in changed:
+                watcher.setDirs(getWatchedDirs(projectDir))
+    except KeyboardInterrupt:
+        print
+    finally:
+        watcher.close()
+
+
 '''
     SUBPROGRAM: HAL package acquisition script
 '''
 def acquireHALpackage(filename):
     print "Acquiring HAL package from '" + filename + "'"
-    if os.path.isdir(TEMP_DIR):
-        shutil.rmtree(TEMP_DIR)
-    os.makedirs(TEMP_DIR)
     zf = zipfile.ZipFile(filename, 'r')
-    print "Extracting HAL package..."
-    zf.extractall(TEMP_DIR)
 
-    HAL_PACK_DIR = TEMP_DIR + "/" + os.listdir(TEMP_DIR)[0]
+    packageXMLNames = [n for n in zf.namelist() if n.split('/')[-1] == 'package.xml']
+    if len(packageXMLNames) == 0:
+        ERROR("Invalid HAL package")
+    packageXMLName = min(packageXMLNames, key=len)
+    HAL_PACK_ROOT = packageXMLName[:-len('package.xml')]
 
-    packageXML = xml.etree.ElementTree.parse(HAL_PACK_DIR + '/package.xml').getroot()
+    packageXML = xml.etree.ElementTree.fromstring(zf.read(packageXMLName))
     releaseString = packageXML[0].attrib['Release']
     releaseStringTokens = releaseString.split('.', 2)
     if releaseStringTokens[0] != 'FW':
@@ -578,171 +3529,340 @@ def acquireHALpackage(filename):
     packageFamilySeriesString = "STM32" + ("F" if packageFamilyID == 0 else "L") + str(packageSeriesID)
     print "\n[Package info]\n" + packageFamilySeriesString + " series\nHAL version " + packageVersionString + "\n"
 
-    searchedTemplate = getTemplateBasenameFor(packageFamilyID, packageSeriesID)
-    if searchedTemplate is None:
+    templatesIndex = loadTemplatesIndex()
+    latestTemplate = getTemplateBasenameFor(packageFamilyID, packageSeriesID, index=templatesIndex)
+    if latestTemplate is None:
         INFO("A local {} package does not already exist, will now be acquired".format(packageFamilySeriesString))
+    elif getTemplateBasenameFor(packageFamilyID, packageSeriesID, packageVersionString, templatesIndex) is not None:
+        INFO("There's already a package with the same version of the package provided")
+        print "Nothing to do"
+        return False
     else:
-        existingVersion = int(getTemplateInfo(searchedTemplate)['versionNum'])
-        if packageVersionNum <= existingVersion:
-            INFO("There's already a package with same or lower version to the package provided")
-            print "Nothing to do, cleaning up..."
-            if os.path.isdir(TEMP_DIR):
-                shutil.rmtree(TEMP_DIR)
-            sys.exit(0)
-        else:
-            INFO("There's already a {} package but will be updated".format(packageFamilySeriesString))
+        # Older versions are kept for the projects created with them
+        INFO("There's already a {} package with HAL version {}, the new one will be added".format(
+             packageFamilySeriesString, templatesIndex[latestTemplate]['versionString']))
 
+    # The template is built by mapping the required members of the package to
+    # their path inside the template, later entries override earlier ones
     print "\nBuilding template from the package..."
-    TEMPLATE_DIR = TEMP_DIR + "/template"
-    if os.path.isdir(TEMPLATE_DIR):
-        shutil.rmtree(TEMPLATE_DIR)
-    os.makedirs(TEMPLATE_DIR + "/src")
-    os.makedirs(TEMPLATE_DIR + "/libs")
-    os.makedirs(TEMPLATE_DIR + "/system/hal")
-    os.makedirs(TEMPLATE_DIR + "/system/cmsis")
-    os.makedirs(TEMPLATE_DIR + "/ldscripts")
+    templateFiles = collections.OrderedDict()
+    templateDirs = ['src', 'libs', 'system', 'system/hal', 'system/cmsis', 'ldscripts']
 
     print "[CMSIS]"
-    CMSIS_DRIVER_DIR = HAL_PACK_DIR + "/Drivers/CMSIS"
-    CMSIS_DEVICE_DIR = CMSIS_DRIVER_DIR + "/Device/ST/" + os.listdir(CMSIS_DRIVER_DIR + "/Device/ST")[0]
-    copyDirContent(CMSIS_DRIVER_DIR + "/Include", TEMPLATE_DIR + "/system/cmsis")
-    copyDirContent(CMSIS_DEVICE_DIR + "/Include", TEMPLATE_DIR + "/system/cmsis")
-    for f in os.listdir(TEMPLATE_DIR + "/system/cmsis"):
-        if "system_" in f:
-            shutil.move(TEMPLATE_DIR + "/system/cmsis/" + f, TEMPLATE_DIR + "/system/")
-    for f in os.listdir(CMSIS_DEVICE_DIR + "/Source/Templates"):
-        if "system_" in f:
-            shutil.copyfile(CMSIS_DEVICE_DIR + "/Source/Templates/" + f, TEMPLATE_DIR + "/system/" + f)
-    copyDirContent(CMSIS_DEVICE_DIR + "/Source/Templates/gcc", TEMPLATE_DIR + "/system")
-    if os.path.isdir(TEMPLATE_DIR + "/system/linker"):
-        shutil.rmtree(TEMPLATE_DIR + "/system/linker")
+    CMSIS_DRIVER_DIR = HAL_PACK_ROOT + "Drivers/CMSIS/"
+    deviceDirs = listZipSubdirs(zf, CMSIS_DRIVER_DIR + "Device/ST/")
+    if len(deviceDirs) == 0:
+        ERROR("Couldn't find CMSIS device subfolder")
+    CMSIS_DEVICE_DIR = CMSIS_DRIVER_DIR + "Device/ST/" + deviceDirs[0] + "/"
+    for includeDir in (CMSIS_DRIVER_DIR + "Include/", CMSIS_DEVICE_DIR + "Include/"):
+        for member, path in listZipDir(zf, includeDir):
+            if "system_" in path and not '/' in path:
+                templateFiles["system/" + path] = member
+            else:
+                templateFiles["system/cmsis/" + path] = member
+    for member, path in listZipDir(zf, CMSIS_DEVICE_DIR + "Source/Templates/", recursive=False):
+        if "system_" in path:
+            templateFiles["system/" + path] = member
+    for member, path in listZipDir(zf, CMSIS_DEVICE_DIR + "Source/Templates/gcc/"):
+        if not path.startswith("linker/"):
+            templateFiles["system/" + path] = member
 
     print "[STM32Cube HAL]"
-    HAL_DRIVER_DIR = ""
-    for d in os.listdir(HAL_PACK_DIR + "/Drivers"):
-        if os.path.isdir(HAL_PACK_DIR + "/Drivers/" + d):
-            if "HAL" in d:
-                HAL_DRIVER_DIR = HAL_PACK_DIR + "/Drivers/" + d
-    if HAL_DRIVER_DIR == "":
+    halDirs = [d for d in listZipSubdirs(zf, HAL_PACK_ROOT + "Drivers/") if "HAL" in d]
+    if len(halDirs) == 0:
         ERROR("Couldn't find HAL driver subfolder")
-    copyDirContent(HAL_DRIVER_DIR + "/Src", TEMPLATE_DIR + "/system/hal")
-    copyDirContent(HAL_DRIVER_DIR + "/Inc", TEMPLATE_DIR + "/system/hal")
-    for f in os.listdir(TEMPLATE_DIR + "/system/hal"):
-        if "_conf_template" in f:
-            newName = f.replace('_template', '')
-            shutil.move(TEMPLATE_DIR + "/system/hal/" + f, TEMPLATE_DIR + "/src/" + newName)
-
-    print "\nPacking the template..."
-    templateBasename = "stm32" + packageFamilyString.lower() + str(packageSeriesID)
-    if not os.path.isdir(TEMPLATES_DIR):
-        os.makedirs(TEMPLATES_DIR)
-    zipDirContent(TEMPLATE_DIR + "/", TEMPLATES_DIR + "/" + templateBasename + ".zip")
-    print "Writing JSON info..."
+    HAL_DRIVER_DIR = HAL_PACK_ROOT + "Drivers/" + halDirs[-1] + "/"
+    for sourceDir in (HAL_DRIVER_DIR + "Src/", HAL_DRIVER_DIR + "Inc/"):
+        for member, path in listZipDir(zf, sourceDir):
+            if "_conf_template" in path and not '/' in path:
+                templateFiles["src/" + path.replace('_template', '')] = member
+            else:
+                templateFiles["system/hal/" + path] = member
+
+    print "\nStoring the template files..."
+    templateBasename = "stm32" + packageFamilyString.lower() + str(packageSeriesID) + "-" + packageVersionString
+    manifest = storeTemplateFiles(zf, templateFiles, templateDirs)
+    zf.close()
+    print "Updating the templates index..."
     templateInfo = {
         'familyID': packageFamilyID,
         'seriesID': packageSeriesID,
         'versionString': packageVersionString,
         'versionNum': packageVersionNum
     }
-    with open(TEMPLATES_DIR + "/" + templateBasename + ".json", 'w') as outfile:
-        json.dump(templateInfo, outfile)
-    print "Cleaning up..."
-    if os.path.isdir(TEMP_DIR):
-        shutil.rmtree(TEMP_DIR)
+    templateInfo.update(getManifestSummary(manifest))
+    # Other acquisitions may be running at the same time, the index is
+    # read again while holding the templates lock
+    with FileLock(TEMPLATES_DIR + "/.lock"):
+        templatesIndex = loadTemplatesIndex(migrate=False)
+        # A template that couldn't be migrated is replaced
+        if templateBasename in templatesIndex and 'files' in templatesIndex[templateBasename]:
+            INFO("A package with the same version has been acquired in the meantime")
+            return False
+        saveTemplateManifest(templateBasename, manifest)
+        templatesIndex[templateBasename] = templateInfo
+        saveTemplatesIndex(templatesIndex)
+    return True
 
 '''
-    SUBPROGRAM: Project creation script
+    SUBPROGRAM: Batch HAL packages download and acquisition
 '''
-def createProject(args):
-    if not args.mcu:
-        ERROR("No MCU model specified. Use something like 'stm32tool new <name> -m STM32F051K8'")
+# Acquire a HAL package inside a worker process. Its output is captured and
+# returned with the result, so that concurrent acquisitions don't interleave
+# their messages. The result is True if the package has been acquired, False
+# if there was nothing to do and None if the acquisition failed
+def acquireHALpackageWorker(filename):
+    output = StringIO.StringIO()
+    sys.stdout = output
+    try:
+        result = acquireHALpackage(filename)
+    except SystemExit:
+        result = None
+    except Exception as e:
+        print CLIFormat.ERROR + "[ERROR] " + str(e) + CLIFormat.ENDF
+        result = None
+    finally:
+        sys.stdout = sys.__stdout__
+    return (result, output.getvalue())
+
+# Find and download (or take from the cache) the HAL package of a series,
+# inside a worker thread. Returns (series name, package filename, error)
+def downloadHALpackageWorker(seriesName):
+    series = MCU.getSeriesFromName(seriesName)
+    if series is None:
+        return (seriesName, None, "not a valid MCU series")
+    url = getHALDownloadLink(series['family'], series['series'])
+    if url is None:
+        return (seriesName, None, "couldn't find the package URL")
+    package = cacheFetchPackage(url)
+    if package is None:
+        return (seriesName, None, "download failed")
+    return (seriesName, package, None)
+
+# Download the packages of all the 'seriesNames' and acquire them together
+# with the local package 'filenames'. Downloads run in a pool of threads, since
+# they are bound to the network, while each acquisition runs in a pool of
+# processes as soon as its package is available.
+# Returns True if all the packages have been acquired or were already present
+def acquireHALpackages(filenames, seriesNames=()):
+    global SHOW_DOWNLOAD_PROGRESS
+    SHOW_DOWNLOAD_PROGRESS = False
+
+    results = collections.OrderedDict()
+    for name in list(seriesNames) + list(filenames):
+        results[name] = None
+    acquirePool = multiprocessing.Pool(getCPUcount())
+    pending = []
+    for filename in filenames:
+        pending.append((filename, acquirePool.apply_async(acquireHALpackageWorker, (filename,))))
+
+    if len(seriesNames) > 0:
+        print "Downloading {} packages...".format(len(seriesNames))
+        downloadPool = multiprocessing.pool.ThreadPool(min(len(seriesNames), MAX_PARALLEL_DOWNLOADS))
+        for name, package, error in downloadPool.imap_unordered(downloadHALpackageWorker, seriesNames):
+            if package is None:
+                WARNING(name + ": " + error)
+                results[name] = "failed (" + error + ")"
+            else:
+                print "Downloaded " + name + " package " + os.path.basename(package)
+                pending.append((name, acquirePool.apply_async(acquireHALpackageWorker, (package,))))
+        downloadPool.close()
+        downloadPool.join()
+    acquirePool.close()
+
+    for name, asyncResult in pending:
+        # A timeout on get() keeps the wait interruptible with CTRL+C
+        result, output = asyncResult.get(365 * 24 * 3600)
+        print "\n" + output.strip()
+        if result is None:
+            results[name] = "failed"
+        else:
+            results[name] = "acquired" if result else "already up to date"
+    acquirePool.join()
+
+    print "\nSummary:"
+    for name in results:
+        print CLIFormat.ROWNAME + "[" + name + "]" + CLIFormat.ENDF + " " + results[name]
+    return all(not r.startswith("failed") for r in results.values())
 
+'''
+    SUBPROGRAM: Project creation script
+'''
+# Return the MCU object for a MCU name, with its RAM size from 'mcuDB' (loaded
+# when None), updating the database if the MCU isn't there.
+# Returns the MCU and the database
+def resolveProjectMCU(mcuName, ram=None, mcuDB=None):
     mcu = MCU()
 
-    if mcu.loadFromName(args.mcu) == False:
-        ERROR("The specified MCU name is not valid")
+    if mcu.loadFromName(mcuName) == False:
+        ERROR("The MCU name '" + mcuName + "' is not valid")
 
-    if args.ram:
+    if ram:
         WARNING("The MCU RAM size has been manually specified, if it's wrong you're going to have problems")
-        mcu.ram = int(args.ram)
+        mcu.ram = int(ram)
     else:
-        mcuDB = loadMCUdatabase()
+        loaded = mcuDB is None
+        if loaded:
+            mcuDB = loadMCUdatabase()
         dbExists = False if mcuDB is None else True
-        mcuFound = mcu.loadFromDB(mcuDB, args.mcu) if mcuDB is not None else False
+        mcuFound = mcu.loadFromDB(mcuDB, mcuName) if mcuDB is not None else False
         if (not dbExists) or (not mcuFound):
             if mcuDB is None: print "No local MCU database found, downloading now"
             elif not mcuFound: print "The MCU is not in the database. Maybe the DB is obsolete, updating now"
             mcuDB = updateMCUdatabase()
             if mcuDB is None:
                 ERROR("Couldn't load or update the database, you must manually specify the MCU RAM size")
-        if mcu.loadFromDB(mcuDB, args.mcu) == False:
-            if dbExists: ERROR("The MCU isn't in the updated database too, check the MCU name or manually specify the RAM size")
-            else: ERROR("The MCU does not exist in the ST database")
-
-
-    print "Creating new project '" + args.project + "'\n"
+        elif loaded:
+            # The part is known, so stale data is good enough for now
+            refreshMCUdatabaseIfStale(mcuDB)
+        if mcu.loadFromDB(mcuDB, mcuName) == False:
+            if dbExists: ERROR("The MCU " + mcuName + " isn't in the updated database too, check the MCU name or manually specify the RAM size")
+            else: ERROR("The MCU " + mcuName + " does not exist in the ST database")
+    return (mcu, mcuDB)
 
-    print "Searching a suitable template package..."
-    templateBasename = getTemplateBasenameFor(mcu.familyID, mcu.seriesID)
+# Return the template for a MCU, of the HAL version 'halVersion' or the latest
+# one, downloading it if needed, and the CMSIS model file of the MCU.
+# Returns the template basename, the template index and the model file
+def resolveProjectTemplate(mcu, halVersion=None, index=None):
+    if index is None:
+        index = loadTemplatesIndex()
+    templateBasename = getTemplateBasenameFor(mcu.familyID, mcu.seriesID, halVersion, index)
     if templateBasename is None:
-        print "Couldn't find a suitable local template package, trying to download..."
+        if halVersion:
+            print "Couldn't find a local template package with HAL version " + halVersion + ", trying to download the latest one..."
+        else:
+            print "Couldn't find a suitable local template package, trying to download..."
         url = getHALDownloadLink(mcu.familyID, mcu.seriesID)
         if url is None:
             ERROR(  "Couldn't find the URL for the required template package",
                     "You must manually download the HAL libraries and acquire the package")
-        downloadedPackage = downloadFile(url, saveToDisk=True, location='.')
+        downloadedPackage = cacheFetchPackage(url)
         if downloadedPackage is None:
             ERROR("Download failed or canceled by the user")
         acquireHALpackage(downloadedPackage)
-        templateBasename = getTemplateBasenameFor(mcu.familyID, mcu.seriesID)
+        index = loadTemplatesIndex()
+        templateBasename = getTemplateBasenameFor(mcu.familyID, mcu.seriesID, halVersion, index)
+        if templateBasename is None:
+            ERROR(  "The HAL version " + halVersion + " isn't the latest one, so it can't be downloaded automatically",
+                    "You must manually download the HAL libraries and acquire the package")
         print ""
+    modelFile = findModelForMCU(index[templateBasename]['models'], mcu.name)
+    if modelFile is None:
+        ERROR("Couldn't find the model file of " + mcu.name + ", ensure the MCU name is correct")
+    return (templateBasename, index, modelFile)
 
-    print "Initializing project directory..."
-    PROJECT_DIR = "./" + args.project
-    if os.path.isdir(PROJECT_DIR):
-        ERROR(  "A folder with the specified project name already exists",
-                "If you want to update the ST HAL, use the <upgrade> command")
-    else:
-        os.makedirs(PROJECT_DIR)
+# Return the key of the test compilation of a new project, the hash of all its
+# result depends on: the template and model, the common files, the generated
+# config.mk and linker script, and the compiler version
+def getVerificationKey(projectDir, templateBasename, modelFile):
+    keyHash = hashlib.sha256()
+    keyHash.update(templateBasename + '\0' + modelFile + '\0')
+    keyHash.update(getCompilerVersion('arm-none-eabi-gcc') + '\0')
+    commonDir = TEMPLATES_DIR + "/common"
+    for root, dirs, files in os.walk(commonDir):
+        dirs.sort()
+        for f in sorted(files):
+            keyHash.update(os.path.relpath(root + "/" + f, commonDir) + '\0')
+            with open(root + "/" + f, 'rb') as fh:
+                keyHash.update(fh.read() + '\0')
+    for path in ("config.mk", "ldscripts/mem.ld"):
+        with open(projectDir + "/" + path, 'rb') as f:
+            keyHash.update(path + '\0' + f.read() + '\0')
+    return keyHash.hexdigest()
 
-    print "[CMSIS, HAL and project structure]"
-    zf = zipfile.ZipFile(TEMPLATES_DIR + "/" + templateBasename + ".zip", 'r')
-    zf.extractall(PROJECT_DIR)
+# Copy a project to another directory, without its build files. The 'system'
+# files, which a build doesn't change, are hardlinked when possible
+def copyProjectTree(srcDir, dstDir):
+    for root, dirs, files in os.walk(srcDir):
+        relativeRoot = os.path.relpath(root, srcDir)
+        if relativeRoot == '.':
+            dirs[:] = [d for d in dirs if not d in ('build', PROJECT_TOOL_DIR)]
+        os.makedirs(os.path.normpath(dstDir + "/" + relativeRoot))
+        for f in files:
+            dst = os.path.normpath(dstDir + "/" + relativeRoot + "/" + f)
+            if relativeRoot.split('/')[0] == "system":
+                linkFile(root + "/" + f, dst)
+            else:
+                shutil.copy2(root + "/" + f, dst)
 
-    print "[Startup file]"
-    modelFile = getModelFileForMCU(PROJECT_DIR, mcu.name)
-    if modelFile is None:
-        shutil.rmtree(PROJECT_DIR)
-        ERROR("Couldn't find the MCU model file, ensure the MCU name is correct")
-    for f in os.listdir(PROJECT_DIR + "/system"):
-        if "startup_" in f:
-            if f != "startup_" + modelFile + ".s":
-                os.remove(PROJECT_DIR + "/system/" + f)
-
-    print "[CMSIS configuration]"
-    for f in os.listdir(PROJECT_DIR + "/system/cmsis"):
-        if "stm32" in f and len(f.split('.')[0]) >= 11:
-            if f != modelFile + ".h":
-                os.remove(PROJECT_DIR + "/system/cmsis/" + f)
-
-    print "[Linker script]"
-    with open(PROJECT_DIR + "/ldscripts/mem.ld", 'w') as f:
+# Run the test compilation of a new project, unless one with the same
+# configuration (see getVerificationKey()) already succeeded. The project is
+# compiled in a scratch copy under TEMP_DIR, leaving the project untouched, and
+# the projects of a batch with the same configuration are compiled once.
+# Returns the same as compileProject() and True if the result was cached
+def verifyProject(projectDir, templateBasename, modelFile, jobserver=None):
+    try:
+        key = getVerificationKey(projectDir, templateBasename, modelFile)
+    except (IOError, OSError):
+        key = None
+    with verifyProject.locksGuard:
+        lock = verifyProject.locks.setdefault(key, threading.Lock())
+    with lock:
+        return verifyProjectUnlocked(projectDir, key, jobserver)
+
+verifyProject.locks = { }
+verifyProject.locksGuard = threading.Lock()
+
+def loadVerifiedBuilds():
+    try:
+        with open(VERIFIED_BUILDS_FILE) as f:
+            return json.load(f)
+    except:
+        return { }
+
+def verifyProjectUnlocked(projectDir, key, jobserver):
+    verified = loadVerifiedBuilds()
+    if key in verified:
+        return ((True, "", verified[key]['flash'], verified[key]['ram']), True)
+
+    if not os.path.isdir(TEMP_DIR):
+        os.makedirs(TEMP_DIR)
+    scratchDir = tempfile.mkdtemp(prefix="verify-", dir=TEMP_DIR)
+    try:
+        # The copy has the same name, which the Makefile uses for the outputs
+        scratchProject = scratchDir + "/" + os.path.basename(os.path.abspath(projectDir))
+        copyProjectTree(projectDir, scratchProject)
+        result = compileProject(scratchProject, buildHALlib=True, jobserver=jobserver)
+    finally:
+        shutil.rmtree(scratchDir, ignore_errors=True)
+    if result[0] and key is not None:
+        with FileLock(VERIFIED_BUILDS_FILE + ".lock"):
+            verified = loadVerifiedBuilds()
+            verified[key] = { 'flash': result[2], 'ram': result[3], 'time': time.time() }
+            writeJSONAtomic(VERIFIED_BUILDS_FILE, verified)
+    return (result, False)
+
+# Create the files of a project in 'projectDir' (which must not exist) for a
+# MCU, from a template. With 'verbose' each step is printed
+def populateProject(projectDir, mcu, templateBasename, modelFile, link=False, manifest=None, verbose=True):
+    def step(name):
+        if verbose:
+            print name
+
+    mcu.template = templateBasename
+    os.makedirs(projectDir)
+
+    step("[CMSIS, HAL and project structure]")
+    materializeTemplate(templateBasename, projectDir, modelFile, link, manifest)
+
+    step("[Linker script]")
+    with open(projectDir + "/ldscripts/mem.ld", 'w') as f:
         f.write("MEMORY\n")
         f.write("{\n")
         f.write("  FLASH (rx) : ORIGIN = 0x08000000, LENGTH = " + str(mcu.flash) + "K\n")
         f.write("  RAM (xrw) : ORIGIN = 0x20000000, LENGTH = " + str(mcu.ram) + "K\n")
         f.write("}\n")
 
-    print "[Makefile and common files]"
-    copyDirContent(TEMPLATES_DIR + "/common", PROJECT_DIR)
-    cmsisInclude = getCMSISinclude(PROJECT_DIR)
-    replaceInFile(PROJECT_DIR + "/src/main.c", "!CMSIS_FAMILY_INCLUDE!", cmsisInclude)
-    replaceInFile(PROJECT_DIR + "/system/newlib/sbrk.c", "!CMSIS_FAMILY_INCLUDE!", cmsisInclude)
+    step("[Makefile and common files]")
+    copyDirContent(TEMPLATES_DIR + "/common", projectDir)
+    cmsisInclude = getCMSISinclude(projectDir)
+    replaceInFile(projectDir + "/src/main.c", "!CMSIS_FAMILY_INCLUDE!", cmsisInclude)
+    replaceInFile(projectDir + "/system/newlib/sbrk.c", "!CMSIS_FAMILY_INCLUDE!", cmsisInclude)
 
-    print "[config.mk]"
+    step("[config.mk]")
     mcuDefine = modelFile.upper().replace('X', 'x')
     fpuFlags = " -mfloat-abi=hard -mfpu=fpv4-sp-d16" if mcu.fpu == True else ""
-    with open(PROJECT_DIR + "/config.mk", 'w') as f:
+    with open(projectDir + "/config.mk", 'w') as f:
         f.write("# This file has been automatically generated by stm32tool\n")
         f.write("# Feel free to change some options if you like\n\n")
         f.write("CPU = -mcpu=" + mcu.cpuName + fpuFlags + "\n")
@@ -752,35 +3872,186 @@ def createProject(args):
         f.write("MCU = -D" + mcuDefine + "\n")
         f.write("STARTUP = system/startup_" + modelFile + ".s\n")
         f.write("BTLPORT = /dev/ttyUSB0\n")
+        f.write("\n# Compile the HAL in this many translation units (or 'auto', one for each\n")
+        f.write("# CPU core) instead of one for each source, which makes clean builds faster\n")
+        f.write("# HAL_UNITY_BATCHES = auto\n")
+        f.write("\n# Make the build fail when the memory use exceeds a budget, or when it grows\n")
+        f.write("# more than a limit since the previous build (in bytes, or like 64k)\n")
+        f.write("# FLASH_BUDGET = " + str(mcu.flash) + "k\n")
+        f.write("# RAM_BUDGET = " + str(mcu.ram) + "k\n")
+        f.write("# FLASH_GROWTH_LIMIT = 1k\n")
+        f.write("# RAM_GROWTH_LIMIT = 1k\n")
+
+    step("[MCU info file]")
+    mcu.exportJSON(projectDir + "/mcu.json")
+    registerProject(projectDir)
+
+def createProject(args):
+    if not args.mcu:
+        ERROR("No MCU model specified. Use something like 'stm32tool new <name> -m STM32F051K8'")
+
+    mcu, mcuDB = resolveProjectMCU(args.mcu, args.ram)
 
-    print "[MCU info file]"
-    mcu.exportJSON(PROJECT_DIR + "/mcu.json")
+    print "Creating new project '" + args.project + "'\n"
+
+    print "Searching a suitable template package..."
+    templateBasename, index, modelFile = resolveProjectTemplate(mcu, args.hal)
+    print "Using the template package with HAL version " + index[templateBasename]['versionString']
+
+    print "Initializing project directory..."
+    PROJECT_DIR = "./" + args.project
+    if os.path.isdir(PROJECT_DIR):
+        ERROR(  "A folder with the specified project name already exists",
+                "If you want to update the ST HAL, use the <upgrade> command")
 
-    print "[Cleaning up unnecessary files]"
-    for f in os.listdir(PROJECT_DIR + "/system/hal"):
-        if "_template" in f:
-            os.remove(PROJECT_DIR + "/system/hal/" + f)
+    populateProject(PROJECT_DIR, mcu, templateBasename, modelFile, args.link or getConfig('linkTemplates'))
 
     print "\nProject is ready, running a test compilation..."
-    if compileProject(PROJECT_DIR)[0] == False:
+    result, cached = verifyProject(PROJECT_DIR, templateBasename, modelFile)
+    if result[0] == False:
         WARNING("Something went wrong with the compilation, you must manually check, sorry for that")
         WARNING("Please report the error to the developer so it can be fixed, thanks!")
     else:
+        if cached:
+            print "A project with the same configuration was already compiled successfully"
         print "All went fine! Your new project is ready, it's time to code!"
-    cleanProject(PROJECT_DIR)
+
+# Read a manifest of projects to create: one 'name:MCU[:RAM]' entry per line, with
+# the empty lines and the comments (from '#') ignored
+def loadProjectsManifest(filename):
+    entries = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if len(line) > 0:
+                entries.append(line)
+    return entries
+
+# Create many projects, given as 'name:MCU' entries, or 'name:MCU:RAM' to give
+# the RAM amount in kB of that MCU. The MCU database and the templates are
+# loaded once, then all the projects are created and their test compilations
+# run at the same time sharing a MakeJobserver, and a summary is printed.
+# Returns True if all the test compilations succeeded
+def createProjects(args, entries):
+    if len(entries) > 1 and args.ram is not None:
+        ERROR("The RAM amount applies to a single project", "Give it in the entry of each project, like board1:STM32F407VG:192")
+    projects = collections.OrderedDict()
+    for entry in entries:
+        fields = entry.split(':')
+        if not len(fields) in (2, 3) or len(fields[0]) == 0 or len(fields[1]) == 0 or \
+           (len(fields) == 3 and not fields[2].isdigit()):
+            ERROR("Invalid project '" + entry + "', use the name:MCU or name:MCU:RAM format (like board1:STM32F407VG)")
+        name, mcuName = fields[:2]
+        if name in projects:
+            ERROR("The project '" + name + "' is given more than once")
+        if os.path.isdir(name):
+            ERROR("A folder named '" + name + "' already exists")
+        projects[name] = { 'mcuName': mcuName, 'ram': int(fields[2]) if len(fields) == 3 else args.ram }
+
+    # Everything is checked before creating the first project
+    mcuDB = None
+    index = None
+    for name, project in projects.items():
+        project['mcu'], mcuDB = resolveProjectMCU(project['mcuName'], project['ram'], mcuDB)
+        project['template'], index, project['modelFile'] = resolveProjectTemplate(project['mcu'], args.hal, index)
+
+    print "Creating {} projects...".format(len(projects))
+    manifests = { }
+    for name, project in projects.items():
+        if not project['template'] in manifests:
+            manifests[project['template']] = loadTemplateManifest(project['template'])
+        populateProject(name, project['mcu'], project['template'], project['modelFile'],
+                        args.link or getConfig('linkTemplates'), manifests[project['template']], verbose=False)
+        print "Created " + name + " (" + project['mcu'].name + ", " + project['template'] + ")"
+
+    print "\nRunning the test compilations..."
+    jobs = getCPUcount() + 1
+    makes = min(len(projects), jobs)
+    jobserver = MakeJobserver(jobs, makes)
+
+    def testProject(name):
+        startTime = time.time()
+        result, cached = verifyProject(name, projects[name]['template'], projects[name]['modelFile'], jobserver)
+        return (name, result, cached, time.time() - startTime)
+
+    buildPool = multiprocessing.pool.ThreadPool(makes)
+    for name, result, cached, duration in buildPool.imap_unordered(testProject, projects.keys()):
+        projects[name]['result'] = result
+        projects[name]['cached'] = cached
+        projects[name]['duration'] = duration
+        if result[0] == False:
+            WARNING("The test compilation of " + name + " failed:")
+            print result[1]
+    buildPool.close()
+    buildPool.join()
+    jobserver.close()
+
+    print "\nSummary:"
+    width = max(len(name) for name in projects) + 4
+    for name, project in projects.items():
+        result = project['result']
+        details = "{:<14}{:<18}".format(project['mcu'].name, project['template'])
+        if result[0] == False:
+            details += CLIFormat.ERROR + "test compilation failed" + CLIFormat.ENDF
+        else:
+            details += "ok  {:>6.1f} s    FLASH {:.1f} kB    RAM {:.1f} kB{}".format(
+                       project['duration'], result[2] / 1024.0, result[3] / 1024.0,
+                       "    (cached)" if project['cached'] else "")
+        print CLIFormat.ROWNAME + name.ljust(width) + CLIFormat.ENDF + details
+    return all(project['result'][0] for project in projects.values())
 
 
 '''
     ArgParse configuration
 '''
+# The project Makefile runs the compiler through the tool to use the object
+# cache, with arguments that aren't meant for the parser
+if len(sys.argv) > 2 and sys.argv[1] == 'cc-wrapper':
+    sys.exit(runToolWrapper(sys.argv[2:]))
+
 parser = argparse.ArgumentParser(description='Simple CLI tool to deal with the creation, compilation, management and distribution of STM32 projects and software under Linux')
 
-parser.add_argument('command', choices=['new', 'info', 'build', 'rebuild', 'flash', 'flash-btl', 'acquire', 'download'], help='The operation to perform')
-parser.add_argument('project', help='The name of the project (folder) to operate within')
+parser.add_argument('command', choices=['new', 'info', 'build', 'rebuild', 'flash', 'flash-btl', 'acquire', 'download', 'cache', 'search', 'db', 'templates', 'objcache', 'watch', 'size', 'sweep'], help='The operation to perform')
+parser.add_argument('project', nargs='*', help='The name of the project (folder) to operate within (more than one, or a pattern like boards/*, to build many projects at once), name:MCU entries to create many projects at once, the MCU series or package files for the download and acquire commands (more than one allowed), the operation for the cache command (ls, prune), the MCU name prefix or pattern (like STM32F4*VG) for the search command, the operation for the db command (update, status) for the templates command (ls, gc, rm <template>, export <template>) or for the objcache command (stats, clear)')
 parser.add_argument('-m', '--mcu', help='The MCU model name when creating a project')
 parser.add_argument('-r', '--ram', help='The MCU RAM amount in [kB] when creating a project', type=int)
+parser.add_argument('--link', action='store_true', help='Hardlink the system files of the new project to the unpacked template instead of extracting them')
+parser.add_argument('--manifest', help='A file listing the projects to create, one name:MCU (or name:MCU:RAM) entry per line')
+parser.add_argument('--hal', help='The HAL version (like 1.7.1) of the template when creating a project, the latest one available by default')
+parser.add_argument('--min-flash', help='Minimum flash size in [kB] of the MCUs to search', type=int)
+parser.add_argument('--max-flash', help='Maximum flash size in [kB] of the MCUs to search', type=int)
+parser.add_argument('--min-ram', help='Minimum RAM size in [kB] of the MCUs to search', type=int)
+parser.add_argument('--max-ram', help='Maximum RAM size in [kB] of the MCUs to search', type=int)
+parser.add_argument('--async', dest='background', action='store_true', help='Run the database update in background')
+parser.add_argument('--profile', action='store_true', help='Record the time taken by each step of the build and report the slowest ones')
+parser.add_argument('--time-report', action='store_true', help='Also collect the -ftime-report data of each compilation when profiling (implies --profile)')
+parser.add_argument('--fail-fast', action='store_true', help='Stop building the projects at the first failure when building many projects')
+parser.add_argument('--flash', action='store_true', help='Flash the project after each successful build of the watch command')
 args = parser.parse_args()
 
+# Many projects can be created at once from name:MCU entries, given as
+# arguments or in a manifest file
+newEntries = None
+if args.command == 'new' and (args.manifest or len(args.project) > 1 or ':' in ''.join(args.project)):
+    newEntries = list(args.project)
+    if args.manifest:
+        if not os.path.isfile(args.manifest):
+            ERROR("The manifest '" + args.manifest + "' does not exist")
+        newEntries += loadProjectsManifest(args.manifest)
+
+# Only the download, acquire, build and new commands work on many packages or
+# projects at once
+projects = args.project
+if len(projects) == 0 and newEntries is None:
+    parser.error("too few arguments")
+if args.command in ('build', 'rebuild'):
+    projects = [match for pattern in projects for match in (sorted(glob.glob(pattern)) or [pattern])]
+if len(projects) > 1 and not args.command in ('download', 'acquire', 'templates', 'build', 'rebuild', 'new'):
+    ERROR("The '" + args.command + "' command accepts a single project")
+if len(projects) > 1 and (args.profile or args.time_report):
+    ERROR("A build can be profiled only for a single project")
+args.project = projects[0] if len(projects) > 0 else None
+
 '''
     Initial checks
 '''
@@ -794,48 +4065,73 @@ if not os.path.isdir(TEMPLATES_DIR):
 '''
 
 # File/directory existance check
-if not args.command in ('new', 'download', 'acquire'):
-    if not os.path.isdir(args.project):
-        ERROR("The project specified does not exist")
+if not args.command in ('new', 'download', 'acquire', 'cache', 'search', 'db', 'templates', 'objcache'):
+    for project in projects:
+        if not os.path.isdir(project):
+            ERROR("The project '" + project + "' does not exist")
 if args.command in ('acquire'):
-    if not os.path.isfile(args.project):
-        ERROR("The file specified does not exist")
+    packages = []
+    for pattern in projects:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            ERROR("The file '" + pattern + "' does not exist")
+        packages += matches
+    for package in packages:
+        if not os.path.isfile(package):
+            ERROR("The file '" + package + "' does not exist")
 
 # 'new' command
-if args.command == 'new':
+if args.command == 'new' and newEntries is not None:
+    if not createProjects(args, newEntries):
+        ERROR("Some test compilations failed, you must manually check the projects")
+elif args.command == 'new':
     createProject(args)
 
 # 'info' command
 if args.command == 'info':
     mcu = MCU()
     mcu.loadFromJSON(args.project + "/mcu.json")
-    fcount = countFiles(args.project, ('c', 'h'), ('build'))
+    scan = scanProject(args.project, ('c', 'h'))
+    fcount = scan['total']
     print "Project info:"
     print CLIFormat.ROWNAME + "[MCU]      " + CLIFormat.ENDF + str(mcu)
     print CLIFormat.ROWNAME + "[#files]   " + CLIFormat.ENDF + "{} .c, {} .h, {} others ({} total)".format(fcount['c'], fcount['h'], fcount['other'], fcount['total'])
-    print CLIFormat.ROWNAME + "[#lines]   " + CLIFormat.ENDF + str(countCodeLines(args.project, ('c', 'h')))
+    print CLIFormat.ROWNAME + "[#lines]   " + CLIFormat.ENDF + str(fcount['lines'])
+    for directory in ['src', 'libs', 'system'] + sorted(d for d in scan if d not in ('src', 'libs', 'system', '.', 'total')) + ['.']:
+        if directory not in scan or scan[directory]['total'] == 0:
+            continue
+        dcount = scan[directory]
+        print "    {:<10} {:>5} .c, {:>5} .h, {:>5} others, {:>8} lines".format(directory if directory != '.' else "(root)", dcount['c'], dcount['h'], dcount['other'], dcount['lines'])
 
 # 'build' and 'rebuild' commands
-if 'build' in args.command or args.command == 'flash':
+if 'build' in args.command and len(projects) > 1:
+    if not buildProjects(projects, args.command == 'rebuild', args.fail_fast):
+        ERROR("Some projects couldn't be built")
+elif 'build' in args.command or args.command == 'flash':
     if args.command == 'rebuild':
         INFO("Cleaning build files")
         cleanProject(args.project)
     INFO("Building project")
-    result = compileProject(args.project)
-    print result[1]
+    if args.profile or args.time_report:
+        result = profileProject(args.project, args.time_report)
+    else:
+        result = compileProject(args.project, verbose=True)
     if result[0] == False:
         ERROR("Errors during project compilation")
-    print "Compilation successful, memory usage:"
+    print "\nCompilation successful, memory usage:"
     mcu = MCU()
     mcu.loadFromJSON(args.project + "/mcu.json")
-    flashUsed = float(result[2]) / 1024
-    flashUsage = flashUsed / float(mcu.flash) * 100
-    ramUsed = float(result[3]) / 1024
-    ramUsage = ramUsed / float(mcu.ram) * 100
-    print CLIFormat.ROWNAME + "[FLASH]    " + CLIFormat.ENDF + "{:.1f}/{} kB\t({:.1f}%)".format(flashUsed, mcu.flash, flashUsage)
-    print CLIFormat.ROWNAME + "[RAM]      " + CLIFormat.ENDF + "{:.1f}/{} kB\t({:.1f}%)".format(ramUsed, mcu.ram, ramUsage)
+    printMemoryUsage(mcu, result[2], result[3])
 
 
+# 'sweep' command
+if args.command == 'sweep':
+    sweepProject(args.project)
+
+# 'size' command
+if args.command == 'size':
+    printSizeReport(args.project)
+
 # 'flash' command
 if args.command == 'flash':
     flashProject(args.project)
@@ -844,12 +4140,22 @@ if args.command == 'flash':
 if args.command == 'flash-btl':
     flashProject_bootloader(args.project)
 
+# 'watch' command
+if args.command == 'watch':
+    watchProject(args.project, args.flash)
+
 # 'acquire' command
 if args.command == 'acquire':
-    acquireHALpackage(args.project)
+    if len(packages) == 1:
+        acquireHALpackage(packages[0])
+    elif not acquireHALpackages(packages):
+        ERROR("Some packages couldn't be acquired")
 
 # 'download' command
-if args.command == 'download':
+if args.command == 'download' and len(projects) > 1:
+    if not acquireHALpackages([], projects):
+        ERROR("Some packages couldn't be downloaded or acquired")
+elif args.command == 'download':
     series = MCU.getSeriesFromName(args.project)
     if series is None:
         ERROR("The specified MCU series is not valid, use something like 'STM32F4'")
@@ -857,7 +4163,72 @@ if args.command == 'download':
     if url is None:
         ERROR(  "Couldn't find the URL for the required template package",
                 "You must manually download the HAL libraries and acquire the package")
-    downloadedPackage = downloadFile(url, saveToDisk=True, location='.')
+    downloadedPackage = cacheFetchPackage(url)
     if downloadedPackage is None:
         ERROR("Download failed or canceled by the user")
     acquireHALpackage(downloadedPackage)
+
+# 'cache' command
+if args.command == 'cache':
+    if args.project == 'ls':
+        listCache()
+    elif args.project == 'prune':
+        pruneCache()
+    else:
+        ERROR("Unknown cache operation '" + args.project + "'", "Use 'stm32tool cache ls' or 'stm32tool cache prune'")
+
+# 'search' command
+if args.command == 'search':
+    searchMCUdatabase(args.project, args.min_flash, args.max_flash, args.min_ram, args.max_ram)
+
+# 'db' command
+if args.command == 'db':
+    if args.project == 'update' and args.background:
+        if refreshMCUdatabaseInBackground():
+            print "Updating the MCU database in background, the output goes to " + MCU_DB_LOG_FILE
+        else:
+            print "An MCU database update is already running"
+    elif args.project == 'update':
+        # Don't fill the log of background updates with progress lines
+        if not sys.stdout.isatty():
+            SHOW_DOWNLOAD_PROGRESS = False
+        mcuDB = updateMCUdatabase()
+        if mcuDB is None:
+            ERROR("Couldn't update the database")
+        print "The local MCU database has {} MCUs".format(len(mcuDB))
+    elif args.project == 'status':
+        printMCUdatabaseStatus()
+    else:
+        ERROR("Unknown db operation '" + args.project + "'", "Use 'stm32tool db update' or 'stm32tool db status'")
+
+# 'templates' command
+if args.command == 'templates':
+    if args.project in ('rm', 'export'):
+        if len(projects) != 2:
+            ERROR("The '" + args.project + "' operation requires a template name, like 'stm32f4-1.7.1'")
+        if getTemplateInfo(projects[1]) is None:
+            ERROR("The template '" + projects[1] + "' does not exist", "Use 'stm32tool templates ls' to list the local templates")
+    elif len(projects) > 1:
+        ERROR("The '" + args.command + "' command accepts a single operation")
+    if args.project == 'ls':
+        listTemplates()
+    elif args.project == 'gc':
+        collectTemplatesGarbage()
+    elif args.project == 'rm':
+        removeTemplate(projects[1])
+        print "Template '" + projects[1] + "' removed, its files are freed by 'stm32tool templates gc'"
+    elif args.project == 'export':
+        exportTemplate(projects[1], projects[1] + ".zip")
+        print "Template exported to '" + projects[1] + ".zip'"
+    else:
+        ERROR("Unknown templates operation '" + args.project + "'", "Use 'stm32tool templates ls', 'gc', 'rm <template>' or 'export <template>'")
+
+# 'objcache' command
+if args.command == 'objcache':
+    if args.project == 'stats':
+        printObjcacheStats()
+    elif args.project == 'clear':
+        clearObjcache()
+        print "Object cache cleared"
+    else:
+        ERROR("Unknown objcache operation '" + args.project + "'", "Use 'stm32tool objcache stats' or 'stm32tool objcache clear'")